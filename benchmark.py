@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Measures completebox filtering and ordbok_uib_no lookups.
+
+Candidates are synthetic TSV files, dictionary pages are the recordings in
+fixtures/ served by ordbok_stub.py with added latency. Every result is a
+time in seconds, lower is better. Results are printed as JSON, and compared
+against a baseline file of an earlier run when one is given:
+
+    ./benchmark.py --output baseline.json
+    ./benchmark.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import time
+from os import environ, makedirs
+from os.path import dirname, exists, join
+from tempfile import gettempdir, mkdtemp
+from threading import Thread
+
+environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import completebox
+import ordbok_uib_no
+from ordbok_stub import FixturePages, StubServer
+
+FIXTURES_DIRNAME = join(dirname(__file__) or '.', 'fixtures')
+SIZES = [10000, 100000, 1000000]
+QUERY = 'vpn err'
+WORDS = ['server', 'login', 'broken', 'printer', 'vpn', 'access', 'mail',
+         'quota', 'disk', 'backup', 'restore', 'network', 'password', 'reset',
+         'error', 'timeout', 'upgrade', 'license', 'invoice', 'office']
+LOOKUP_WORDS = ['gi', 'liv']
+SUGGESTION_QUERIES = ['gam']
+TOLERANCE = 0.25
+# Slowdowns smaller than this many seconds are noise, not regressions
+NOISE_FLOOR = 0.002
+
+
+def best(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def per_call(fn, repeat, number):
+    return best(lambda: [fn() for _ in range(number)], repeat) / number
+
+
+def make_candidates(filename, size):
+    # Ticket numbers and titles of a few common words, like rt.candidates.tsv
+    rng = random.Random(size)
+    with open(filename, 'w') as f:
+        for i in range(size):
+            title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 8)))
+            f.write('{0}\t{1}\tqueue\n'.format(100000 + i, title))
+
+
+def wait_for(app, condition, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError('benchmark step timed out')
+        app.processEvents()
+        time.sleep(0.0005)
+
+
+def type_query(app, index, matcher, query):
+    # Type the query a key at a time and wait for every prefix to be
+    # filtered completely, like a user reading the list while typing
+    model = completebox.ExactMultipartFilterModel(None)
+    model.setSourceModel(completebox.CandidateListModel(index))
+    model.setCandidateIndex(index, matcher)
+    state = {'first': False, 'done': False}
+    model.filtered.connect(lambda first: state.update(first=state['first'] or first))
+    model._filter.done.connect(lambda generation: state.update(done=generation == model._generation))
+    firsts, dones = [], []
+    for i in range(1, len(query) + 1):
+        state.update(first=False, done=False)
+        started = time.perf_counter()
+        model.setFilterString(query[:i])
+        wait_for(app, lambda: state['first'])
+        firsts.append(time.perf_counter() - started)
+        wait_for(app, lambda: state['done'])
+        dones.append(time.perf_counter() - started)
+    return statistics.median(firsts), max(firsts), statistics.median(dones)
+
+
+def bench_candidates(app, workdir, sizes, repeat):
+    check_search(workdir)
+    results = {}
+    for size in sizes:
+        tsv = join(workdir, 'candidates-{0}.tsv'.format(size))
+        store = join(workdir, 'candidates-{0}.idx'.format(size))
+        if not exists(tsv):
+            logging.warning('generating %d candidates', size)
+            make_candidates(tsv, size)
+        prefix = 'candidates.{0}.'.format(size)
+        lines = completebox.slurp_lines(tsv)
+        results[prefix + 'slurp_lines'] = best(lambda: completebox.slurp_lines(tsv), repeat)
+        results[prefix + 'index'] = best(lambda: completebox.CandidateIndex(lines), repeat)
+        results[prefix + 'store_build'] = best(lambda: completebox.CandidateStore.build(lines, store), repeat)
+        results[prefix + 'store_open'] = best(lambda: completebox.open_store(tsv, store), repeat)
+        index = completebox.open_store(tsv, store)
+        for name, matcher in sorted(completebox.MATCHERS.items()):
+            runs = [type_query(app, index, matcher, QUERY) for _ in range(repeat)]
+            first, worst, done = [min(x) for x in zip(*runs)]
+            results[prefix + name + '.keystroke_first'] = first
+            results[prefix + name + '.keystroke_first_max'] = worst
+            results[prefix + name + '.keystroke_done'] = done
+    return results
+
+
+def expected_rows(lines, text, matcher):
+    # What a search must find, by matching every line on its own
+    terms = [x.lower() for x in text.split()]
+    if matcher.ranked:
+        fuzzy = matcher(terms)
+        rows = [row for row, line in enumerate(lines)
+                if all(completebox.is_subsequence(term, line.lower()) for term in terms)]
+        if terms:
+            rows.sort(key=lambda row: (-fuzzy.score(lines[row]), row))
+        return rows[:fuzzy.TOP_COUNT]
+    exact = matcher(terms)
+    return [row for row, line in enumerate(lines) if exact.rx.search(line)]
+
+
+def check_search(workdir, runs=200, steps=20):
+    # IncrementalSearch must find what a brute force search finds while the
+    # query grows, shrinks, is replaced or cancelled and rows are added, on
+    # both kinds of index. Small chunks and a short top list so that every
+    # query spans several chunks and ranked results get cut.
+    rng = random.Random(0)
+    alphabets = ['abcde 12-', 'abcdeABé .1', 'abcdeй ж.2']
+    chunk_size, top_count = completebox.FILTER_CHUNK_SIZE, completebox.FuzzyMatcher.TOP_COUNT
+    completebox.FILTER_CHUNK_SIZE, completebox.FuzzyMatcher.TOP_COUNT = 7, 20
+    try:
+        for run in range(runs):
+            alphabet = alphabets[run % len(alphabets)]
+            lines = [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 24)))
+                     for _ in range(rng.randint(0, 120))]
+            matcher = completebox.MATCHERS['fuzzy' if run % 2 else 'exact']
+            if run % 4 < 2:
+                store = join(workdir, 'check.idx')
+                completebox.CandidateStore.build(lines, store)
+                index, added = completebox.CandidateStore(store), []
+            else:
+                half = len(lines) // 2
+                index, added, lines = completebox.CandidateIndex(lines[:half]), lines[half:], lines[:half]
+            search = completebox.IncrementalSearch(index, matcher)
+            text, searched, shown = '', None, []
+            for _ in range(steps):
+                action = rng.random()
+                if action < 0.15 and added and searched is not None:
+                    # Rows added while a query is shown, like AsyncFilter does
+                    count = rng.randint(1, len(added))
+                    search.extend(added[:count])
+                    lines, added = lines + added[:count], added[count:]
+                    for rows in search.search(searched, more=True):
+                        shown = list(rows) if matcher.ranked else shown + list(rows)
+                    query = searched
+                else:
+                    if action < 0.55:
+                        text += rng.choice(alphabet)
+                    elif action < 0.8:
+                        text = text[:-rng.randint(1, 3)]
+                    else:
+                        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 6)))
+                    if rng.random() < 0.1:
+                        for _ in search.search(text, cancelled=lambda: True):
+                            pass
+                    shown = []
+                    for rows in search.search(text):
+                        shown = list(rows) if matcher.ranked else shown + list(rows)
+                    query = searched = text
+                expected = expected_rows(lines, query, matcher)
+                if shown != expected:
+                    raise ValueError('{0} search of "{1}" in {2} on {3}: expected {4}, found {5}'.format(
+                        matcher.__name__, query, lines, type(index).__name__, expected, shown))
+    finally:
+        completebox.FILTER_CHUNK_SIZE, completebox.FuzzyMatcher.TOP_COUNT = chunk_size, top_count
+
+
+def bench_lookups(workdir, latency):
+    server = StubServer(FixturePages(FIXTURES_DIRNAME), 'localhost', 0, latency)
+    Thread(target=server.serve_forever, daemon=True).start()
+    origin = 'http://localhost:{0}'.format(server.server_address[1])
+    store = ordbok_uib_no.SqliteStore(join(mkdtemp(dir=workdir), 'cache.sqlite'))
+    lookup = lambda client: ([ordbok_uib_no.Article(client, x) for x in LOOKUP_WORDS] +
+                             [ordbok_uib_no.Suggestions(client, x) for x in SUGGESTION_QUERIES])
+    count = len(LOOKUP_WORDS) + len(SUGGESTION_QUERIES)
+    results = {}
+    client = ordbok_uib_no.CachedHttpClient(ordbok_uib_no.HttpClient(origin=origin), store)
+    results['lookup.cold'] = best(lambda: lookup(client), 1) / count
+    results['lookup.warm_memory'] = best(lambda: lookup(client), 3) / count
+    client = ordbok_uib_no.CachedHttpClient(ordbok_uib_no.HttpClient(origin=origin), store)
+    results['lookup.warm_store'] = best(lambda: lookup(client), 1) / count
+    server.shutdown()
+    return results
+
+
+def check_parse():
+    # Parts of the recorded articles as BeautifulSoup found them, a faster
+    # parser that finds anything else is wrong
+    with open(join(FIXTURES_DIRNAME, 'ordbok_parts.json'), encoding='utf-8') as f:
+        expected = json.load(f)
+    for word, parts in sorted(expected.items()):
+        with open(join(FIXTURES_DIRNAME, 'ordbok_{0}.html'.format(word)), encoding='utf-8') as f:
+            found = ordbok_uib_no.extract_parts(f.read())
+        if [list(x) for x in found] != parts:
+            raise ValueError('parts of "{0}": expected {1}, found {2}'.format(word, parts, found))
+
+
+def bench_parse(repeat):
+    read = lambda name: open(join(FIXTURES_DIRNAME, name), encoding='utf-8').read()
+    check_parse()
+    extract_parts = ordbok_uib_no.extract_parts
+    results = {}
+    for word in LOOKUP_WORDS:
+        html = read('ordbok_{0}.html'.format(word))
+        results['parse.article_{0}'.format(word)] = per_call(lambda: extract_parts(html), repeat, 1000)
+    for query in SUGGESTION_QUERIES:
+        text = read('suggestions_{0}.txt'.format(query))
+        results['parse.suggestions_{0}'.format(query)] = per_call(
+            lambda: ordbok_uib_no.Suggestions.parse(text), repeat, 1000)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Prints current against baseline times, returns the regressed names
+    regressions = []
+    width = max(len(x) for x in results)
+    for name, seconds in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            print('{0:<{1}} {2:12.6f}            new'.format(name, width, seconds), file=sys.stderr)
+            continue
+        ratio = seconds / before if before else float('inf')
+        regressed = ratio > 1 + tolerance and seconds - before > NOISE_FLOOR
+        if regressed:
+            regressions.append(name)
+        print('{0:<{1}} {2:12.6f} {3:12.6f} {4:6.2f}x{5}'.format(
+            name, width, seconds, before, ratio, '  REGRESSION' if regressed else ''), file=sys.stderr)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='benchmark completebox and ordbok_uib_no')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated numbers of candidates')
+    parser.add_argument('--workdir', default=join(gettempdir(), 'completebox-benchmark'),
+                        help='where the generated candidate files are kept between runs')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the stub server adds to every response')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of a measurement, the best one counts')
+    parser.add_argument('--only', choices=['candidates', 'lookups', 'parse', 'check'], action='append',
+                        help='run only these benchmarks, check runs the checks the others start with')
+    parser.add_argument('--output', help='write the results JSON here instead of stdout')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='slowdown against the baseline that counts as a regression')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    makedirs(args.workdir, exist_ok=True)
+    only = args.only or ['candidates', 'lookups', 'parse']
+    results = {}
+    if 'candidates' in only:
+        app = completebox.QApplication(sys.argv)
+        sizes = [int(x) for x in args.sizes.split(',')]
+        results.update(bench_candidates(app, args.workdir, sizes, args.repeat))
+    if 'lookups' in only:
+        results.update(bench_lookups(args.workdir, args.latency))
+    if 'parse' in only:
+        results.update(bench_parse(args.repeat))
+    if 'check' in only:
+        check_parse()
+        check_search(args.workdir)
+    report = {'python': platform.python_version(), 'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(content + '\n')
+    else:
+        print(content)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print('{0} regressions: {1}'.format(len(regressions), ', '.join(regressions)), file=sys.stderr)
+            sys.exit(1)
@@ -1,17 +1,18 @@
 #!/usr/bin/env python
 
+import argparse
 import logging
 import sys
-import re
-from os.path import dirname
-
+from ctypes import (CDLL, POINTER, byref, c_char_p, c_int, c_uint, c_ulong,
+                    c_void_p)
+from os import environ, getuid, unlink
+from os.path import dirname, join
+from queue import Queue
+from socket import socket, AF_UNIX, SOCK_STREAM
+from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
 from subprocess import check_output
-
-import PyQt5
-from PyQt5.QtWidgets import (QApplication, QComboBox, QGridLayout, QVBoxLayout,
-                             QWidget, QDesktopWidget, QCompleter)
-from PyQt5.QtGui import QIcon, QFont, QStandardItemModel
-from PyQt5.QtCore import Qt, QSortFilterProxyModel, QRegExp
+from tempfile import gettempdir
+from threading import Lock, Thread
 
 FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
 logging.basicConfig(format=FORMAT, level=logging.DEBUG)
@@ -23,66 +24,1073 @@ MAX_TICKET_LEN = 6
 # CANDIDATES_FILENAME = '/mnt/big_ext4/btsync/prg/completebox/rt.candidates.tsv'
 # ICON_FILENAME = '/mnt/big_ext4/btsync/prg/completebox/completebox.png'
 CANDIDATES_FILENAME = dirname(__file__) + '/rt.candidates.tsv'
+CANDIDATES_STORE_FILENAME = dirname(__file__) + '/rt.candidates.idx'
 ICON_FILENAME = dirname(__file__) + '/completebox.png'
-RX_SPACES = re.compile(r'\s+')
+SOCKET_FILENAME = join(environ.get('XDG_RUNTIME_DIR') or gettempdir(),
+                       'completebox-{0}.sock'.format(getuid()))
 ADD_TO_FONT_SIZE = 6
+MATCH_MODE = 'fuzzy'
+GRAM_SIZE = 3
+SEARCH_HISTORY = 32
+FILTER_CHUNK_SIZE = 4096
+FLUSH_INTERVAL = 250
+# Command whose output lines are streamed in as candidates, like --command
+CANDIDATES_COMMAND = None
+# Streamed candidates are added at most this often, in seconds, every batch
+# re-runs the filter on the new rows
+STREAM_INTERVAL = 0.1
+STREAM_READ_SIZE = 64 * 1024
+PROGRESS_HEIGHT = 4
+
+
+class XdoTool:
+    def get_active_window(self):
+        output = check_output(['xdotool', 'getactivewindow'])
+        return output.decode('utf8').strip()
+
+    def send_text(self, window, text):
+        check_output(['xdotool', 'windowfocus',
+                      '--sync', window, 'type', text])
+
+
+class LibXdo:
+    """
+    Same interface as XdoTool, but calls libxdo in process and keeps one
+    display connection open, so typing does not spawn any processes.
+    """
+
+    LIBRARIES = ['libxdo.so.3', 'libxdo.so']
+    CURRENTWINDOW = 0
+    # Delay between keystrokes in microseconds, the xdotool type default
+    DELAY = 12000
+
+    def __init__(self, display=None):
+        self.lib = self.load()
+        self.lib.xdo_new.restype = c_void_p
+        self.lib.xdo_new.argtypes = [c_char_p]
+        self.lib.xdo_get_active_window.argtypes = [c_void_p, POINTER(c_ulong)]
+        self.lib.xdo_focus_window.argtypes = [c_void_p, c_ulong]
+        self.lib.xdo_wait_for_window_focus.argtypes = [c_void_p, c_ulong, c_int]
+        self.lib.xdo_enter_text_window.argtypes = [c_void_p, c_ulong, c_char_p,
+                                                   c_uint]
+        self.xdo = self.lib.xdo_new(display)
+        if not self.xdo:
+            raise OSError('libxdo cannot open display')
+        # The display connection is shared by the daemon request threads
+        self.lock = Lock()
+
+    def load(self):
+        for name in self.LIBRARIES:
+            try:
+                return CDLL(name)
+            except OSError:
+                pass
+        raise OSError('libxdo is not available')
+
+    def get_active_window(self):
+        window = c_ulong()
+        with self.lock:
+            if self.lib.xdo_get_active_window(self.xdo, byref(window)) != 0:
+                raise OSError('libxdo cannot get active window')
+        return str(window.value)
+
+    def send_text(self, window, text):
+        window = int(window)
+        with self.lock:
+            self.lib.xdo_focus_window(self.xdo, window)
+            self.lib.xdo_wait_for_window_focus(self.xdo, window, 1)
+            self.lib.xdo_enter_text_window(self.xdo, self.CURRENTWINDOW,
+                                           text.encode('utf8'), self.DELAY)
+
+
+def make_xdo(backend):
+    if backend in ('auto', 'lib'):
+        try:
+            return LibXdo()
+        except OSError as e:
+            if backend == 'lib':
+                raise
+            logging.info('%s, falling back to xdotool', e)
+    return XdoTool()
+
+
+class Daemon:
+    """
+    Single-instance channel of a resident completebox. The daemon listens on
+    a Unix socket, a client sends "summon <window>" and gets back a line with
+    the target window and the selected ticket, which is empty if cancelled.
+    """
+
+    class Server(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+        class RequestHandler(StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline().decode('utf8').strip()
+                command, _, window = line.partition(' ')
+                if command != 'summon':
+                    return
+                window, ticket = self.server.on_summon(window)
+                reply = '{0} {1}\n'.format(window, ticket or '')
+                self.wfile.write(reply.encode('utf8'))
+
+        def __init__(self, filename, on_summon):
+            UnixStreamServer.__init__(self, filename,
+                                      Daemon.Server.RequestHandler)
+            self.on_summon = on_summon
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.server = None
+        self.on_summon_callback = None
+
+    def start(self):
+        try:
+            self.server = Daemon.Server(self.filename, self._call_on_summon)
+        except OSError:
+            if self.running():
+                return False
+            # Stale socket left by a daemon that did not exit cleanly
+            unlink(self.filename)
+            self.server = Daemon.Server(self.filename, self._call_on_summon)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return True
+
+    def running(self):
+        try:
+            with socket(AF_UNIX, SOCK_STREAM) as client:
+                client.connect(self.filename)
+            return True
+        except OSError:
+            return False
+
+    def summon(self, window=''):
+        with socket(AF_UNIX, SOCK_STREAM) as client:
+            client.connect(self.filename)
+            client.sendall('summon {0}\n'.format(window).encode('utf8'))
+            reply = client.makefile('rb').readline().decode('utf8')
+        window, _, ticket = reply.rstrip('\n').partition(' ')
+        return window, ticket or None
+
+    def _call_on_summon(self, window):
+        return self.on_summon_callback(window)
+
+    def observe(self, on_summon):
+        self.on_summon_callback = on_summon
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='CompleteBox')
+    parser.add_argument('--candidates', default=CANDIDATES_FILENAME,
+                        help='candidates TSV file, - to stream them from '
+                        'stdin')
+    parser.add_argument('--command',
+                        help='stream candidates from the output of this '
+                        'shell command, CANDIDATES_COMMAND by default')
+    parser.add_argument('--store', default=CANDIDATES_STORE_FILENAME,
+                        help='compiled candidate store')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile candidates TSV into the store and exit')
+    parser.add_argument('--daemon', action='store_true',
+                        help='stay resident and wait to be summoned')
+    parser.add_argument('--standalone', action='store_true',
+                        help='do not summon a resident instance')
+    parser.add_argument('--mode', choices=['exact', 'fuzzy'],
+                        default=MATCH_MODE,
+                        help='ranked fuzzy matching (needs numpy) or exact '
+                        'multipart matching in file order')
+    parser.add_argument('--xdo', choices=['auto', 'lib', 'tool'],
+                        default='auto',
+                        help='type through libxdo in process or xdotool')
+    parser.add_argument('--send', metavar='TEXT',
+                        help='type TEXT into the active window and exit')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    daemon = Daemon(SOCKET_FILENAME)
+    if args.send is not None:
+        xdo = make_xdo(args.xdo)
+        xdo.send_text(xdo.get_active_window(), args.send)
+        sys.exit()
+    # Candidates piped to this process or from a command given here cannot
+    # be handed to a resident one, a default command can be its own
+    piped = args.candidates == '-' or args.command is not None
+    args.command = args.command or CANDIDATES_COMMAND
+    if not (args.compile or args.daemon or args.standalone or piped):
+        try:
+            window, ticket = daemon.summon()
+            logging.info('summoned resident instance, window %s: %s',
+                         window, ticket)
+            sys.exit()
+        except OSError:
+            logging.info('no resident instance, running standalone')
+
+import mmap
+import struct
+import re
+import time
+from bisect import bisect_left
+from importlib.util import find_spec
+from itertools import count
+from os import read, replace
+from os.path import exists, getmtime
+from queue import PriorityQueue
+from select import select
+from subprocess import PIPE, Popen
+
+import PyQt5
+from PyQt5.QtWidgets import (QApplication, QComboBox, QGridLayout, QVBoxLayout,
+                             QWidget, QDesktopWidget, QCompleter, QProgressBar)
+from PyQt5.QtGui import QIcon, QFont, QStandardItemModel
+from PyQt5.QtCore import (Qt, QAbstractListModel, QAbstractProxyModel,
+                          QModelIndex, QRegExp, QObject, QTimer, pyqtSignal)
+
+
+def parse_line(line):
+    # Take 2 first columns max separated by Tab
+    return ' '.join(line.strip().split('\t')[:2])
 
 
 def slurp_lines(filename):
     lines = []
     with open(filename) as file_:
         for line in file_.readlines():
-            # Take 2 first columns max separated by Tab
-            line = ' '.join(line.strip().split('\t')[:2])
-            lines.append(line)
+            lines.append(parse_line(line))
     return lines
 
 
-class ExactMultipartFilterModel(QSortFilterProxyModel):
+def stream_lines(fd, add, interval=STREAM_INTERVAL):
+    """
+    Read candidate lines from a file descriptor as the source produces them
+    and pass them on as add(lines, last). Lines are collected for up to
+    `interval` seconds, the first ones are passed on right away.
+    """
+    pending = []
+    rest = b''
+    flushed = 0
+    while True:
+        timeout = max(0, flushed + interval - time.monotonic())
+        if not pending or select([fd], [], [], timeout)[0]:
+            data = read(fd, STREAM_READ_SIZE)
+            if not data:
+                break
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+            pending.extend(parse_line(line.decode('utf8', 'replace'))
+                           for line in lines)
+        if pending and time.monotonic() - flushed >= interval:
+            add(pending)
+            pending = []
+            flushed = time.monotonic()
+    if rest:
+        pending.append(parse_line(rest.decode('utf8', 'replace')))
+    add(pending, True)
+
+
+def read_candidates(source, add):
+    """
+    stream_lines from a file object, or from the output of a command given
+    as its Popen. A failing command is logged once its output ends, it
+    would look like a short list otherwise.
+    """
+    if not isinstance(source, Popen):
+        stream_lines(source.fileno(), add)
+        return
+    stream_lines(source.stdout.fileno(), add)
+    status = source.wait()
+    if status:
+        logging.error('candidates command "%s" exited with status %d',
+                      source.args, status)
+
+
+def grams(text):
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+class CandidateIndex:
+    """
+    Trigram index over candidate lines. Each trigram of a lowercased line
+    maps to a posting list of row numbers, so a pattern only has to be
+    matched against rows that contain every trigram of every term.
+    """
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._postings = {}
+        self._chars = None
+        for row, line in enumerate(lines):
+            for gram in grams(line.lower()):
+                self._postings.setdefault(gram, []).append(row)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __getitem__(self, row):
+        return self._lines[row]
+
+    def extend(self, lines):
+        for row, line in enumerate(lines, len(self._lines)):
+            for gram in grams(line.lower()):
+                self._postings.setdefault(gram, []).append(row)
+        self._lines.extend(lines)
+        if self._chars is not None:
+            self._chars.extend(lines)
+
+    def lines(self):
+        return self._lines
+
+    def chars(self):
+        """
+        LineChars of all rows, built on first use, i.e. by the first fuzzy
+        query.
+        """
+        if self._chars is None:
+            self._chars = LineChars(self.lines())
+        return self._chars
+
+    def postings(self, gram):
+        return self._postings.get(gram, ())
+
+    def candidates(self, wanted):
+        """
+        Return sorted rows that contain all of the wanted trigrams, or None
+        when there is nothing to look up and every row is a candidate.
+        """
+        if not wanted:
+            return None
+        postings = sorted((self.postings(gram) for gram in wanted), key=len)
+        if not postings[0]:
+            return []
+        return sorted(set(postings[0]).intersection(*postings[1:]))
+
+
+class CandidateStore(CandidateIndex):
+    """
+    Read-only CandidateIndex backed by a memory-mapped file that is built
+    once from the TSV with CandidateStore.build. Lines are decoded only when
+    a row is requested and trigram postings are looked up by binary search,
+    so opening the store does not depend on the number of rows.
+
+    Layout: header, row offsets (uint64), UTF-8 line data, gram table
+    sorted by key and posting lists (uint32).
+    """
+
+    MAGIC = b'CBOXIDX1'
+    HEADER = struct.Struct('<8sQQQQQQ')
+    GRAM = struct.Struct('<12sQQ')
+
+    class GramKeys:
+        """Sorted gram table keys as a sequence for bisect."""
+
+        def __init__(self, buffer, position, count):
+            self.buffer = buffer
+            self.position = position
+            self.count = count
+
+        def __len__(self):
+            return self.count
+
+        def __getitem__(self, i):
+            return self.entry(i)[0]
+
+        def entry(self, i):
+            return CandidateStore.GRAM.unpack_from(
+                self.buffer, self.position + i * CandidateStore.GRAM.size)
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as file_:
+            self._mmap = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self._count, gram_count, offsets_pos, data_pos,
+         grams_pos, postings_pos) = self.HEADER.unpack_from(self._mmap)
+        if magic != self.MAGIC:
+            raise ValueError('not a candidate store: %s' % filename)
+        view = memoryview(self._mmap)
+        self._offsets = view[offsets_pos:data_pos].cast('Q')
+        self._data_pos = data_pos
+        self._grams = CandidateStore.GramKeys(self._mmap, grams_pos,
+                                              gram_count)
+        self._postings = view[postings_pos:].cast('I')
+        self._chars = None
+
+    def __len__(self):
+        return self._count
+
+    def lines(self):
+        return [self[row] for row in range(self._count)]
+
+    def chars(self):
+        if self._chars is None:
+            size = self._offsets[self._count]
+            data = self._mmap[self._data_pos:self._data_pos + size]
+            if data.isascii():
+                # ASCII rows start at their byte offsets, the data is
+                # lowercased at once instead of row by row
+                self._chars = LineChars()
+                self._chars.append(data.decode('ascii').lower(),
+                                   self._offsets[1:])
+            else:
+                self._chars = LineChars(self.lines())
+        return self._chars
+
+    def __getitem__(self, row):
+        start = self._data_pos + self._offsets[row]
+        end = self._data_pos + self._offsets[row + 1]
+        return self._mmap[start:end].decode('utf8')
+
+    def postings(self, gram):
+        key = gram.encode('utf8').ljust(12, b'\0')
+        i = bisect_left(self._grams, key)
+        if i == len(self._grams):
+            return ()
+        found, start, count = self._grams.entry(i)
+        if found != key:
+            return ()
+        return self._postings[start:start + count]
+
+    @staticmethod
+    def build(lines, filename):
+        index = CandidateIndex(lines)
+        data = [line.encode('utf8') for line in lines]
+        offsets = [0]
+        for line in data:
+            offsets.append(offsets[-1] + len(line))
+        data = b''.join(data)
+        data += b'\0' * (-len(data) % 8)
+        grams = sorted((gram.encode('utf8'), rows)
+                       for gram, rows in index._postings.items())
+
+        offsets_pos = CandidateStore.HEADER.size
+        data_pos = offsets_pos + 8 * len(offsets)
+        grams_pos = data_pos + len(data)
+        postings_pos = grams_pos + CandidateStore.GRAM.size * len(grams)
+        postings_pos += -postings_pos % 8
+
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as file_:
+            file_.write(CandidateStore.HEADER.pack(
+                CandidateStore.MAGIC, len(lines), len(grams), offsets_pos,
+                data_pos, grams_pos, postings_pos))
+            file_.write(struct.pack('<%dQ' % len(offsets), *offsets))
+            file_.write(data)
+            start = 0
+            for key, rows in grams:
+                file_.write(CandidateStore.GRAM.pack(key, start, len(rows)))
+                start += len(rows)
+            file_.write(b'\0' * (postings_pos - file_.tell()))
+            for key, rows in grams:
+                file_.write(struct.pack('<%dI' % len(rows), *rows))
+        replace(temp, filename)
+
+
+def open_store(candidates_filename, store_filename):
+    """
+    Open the compiled store when it is up to date with the TSV. Returns None
+    otherwise, the TSV is then read and indexed like streamed candidates.
+    """
+    if exists(store_filename) and (not exists(candidates_filename) or
+            getmtime(store_filename) >= getmtime(candidates_filename)):
+        logging.info('loading candidate store %s', store_filename)
+        try:
+            return CandidateStore(store_filename)
+        except ValueError as e:
+            logging.warning('%s, rebuild it with --compile', e)
+    return None
+
+
+class CandidateListModel(QAbstractListModel):
+    """
+    List model over a CandidateIndex or CandidateStore. Rows are only
+    fetched from the candidates when a view asks for them.
+    """
+
+    def __init__(self, candidates, parent=None):
+        super(CandidateListModel, self).__init__(parent)
+        self._candidates = candidates
+        self._count = len(candidates)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._count
+
+    def grow(self, count):
+        """
+        Show the rows that were appended to the candidates, up to `count`.
+        Candidates grow off the GUI thread, views only see them from here.
+        """
+        if count > self._count:
+            self.beginInsertRows(QModelIndex(), self._count, count - 1)
+            self._count = count
+            self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role in (Qt.DisplayRole, Qt.EditRole):
+            return self._candidates[index.row()]
+        return None
+
+
+def is_subsequence(term, text):
+    it = iter(text)
+    return all(char in it for char in term)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class LineChars:
+    """
+    Lowercased candidate lines as one array of character codes and the
+    offsets where rows start, so that FuzzyMatcher can match and score a
+    whole batch of rows with a few numpy operations per character. The
+    positions of a character in all the rows are found once and kept sorted,
+    its next occurrence in every row of a batch is then one searchsorted.
+
+    Codes are Latin-1 while all the lines fit, UTF-32 otherwise. numpy is
+    imported here, on the filter thread, so that exact matching and the
+    window do not wait for it.
+    """
+
+    POSITIONS_CACHE_SIZE = 64
+
+    def __init__(self, lines=()):
+        import numpy as np
+        self.codes = np.zeros(0, np.uint8)
+        self.offsets = np.zeros(1, np.int64)
+        self._positions = {}
+        self._latin1_alnum = np.array([chr(code).isalnum()
+                                       for code in range(256)])
+        self.extend(lines)
+
+    def extend(self, lines):
+        import numpy as np
+        lowered = [line.lower() for line in lines]
+        self.append(''.join(lowered),
+                    np.cumsum([len(line) for line in lowered], dtype=np.int64))
+
+    def append(self, text, ends):
+        """
+        Add rows given as their lowercased text joined together and the
+        offsets in it where each of them ends.
+        """
+        import numpy as np
+        try:
+            codes = np.frombuffer(text.encode('latin-1'), np.uint8)
+        except UnicodeEncodeError:
+            codes = np.frombuffer(text.encode('utf-32-le'), np.uint32)
+        start = len(self.codes)
+        ends = np.asarray(ends, np.int64)
+        self.codes = np.concatenate([self.codes, codes])
+        self.offsets = np.concatenate([self.offsets, start + ends])
+        for code, positions in self._positions.items():
+            self._positions[code] = np.concatenate(
+                [positions, start + np.flatnonzero(codes == code)])
+
+    def positions(self, char):
+        # Least recently used characters are dropped first
+        import numpy as np
+        code = ord(char)
+        positions = self._positions.pop(code, None)
+        if positions is None:
+            positions = np.flatnonzero(self.codes == code)
+        self._positions[code] = positions
+        while len(self._positions) > self.POSITIONS_CACHE_SIZE:
+            del self._positions[next(iter(self._positions))]
+        return positions
+
+    def boundaries(self, positions, starts):
+        """
+        Whether characters at `positions` start a word: they are first in
+        their row (`starts`) or follow a character that is not alphanumeric.
+        """
+        import numpy as np
+        before = self.codes[positions - 1]
+        if before.dtype == np.uint8:
+            alnum = self._latin1_alnum[before]
+        else:
+            values, inverse = np.unique(before, return_inverse=True)
+            alnum = np.array([chr(code).isalnum()
+                              for code in values.tolist()], bool)[inverse]
+        return (positions == starts) | ~alnum
+
+
+class ExactMatcher:
+    """
+    Each term must be present in a row, in the order of the terms. Rows are
+    looked up by trigrams and keep the file order.
+    """
+
+    ranked = False
+
+    def __init__(self, terms):
+        self.terms = terms
+        self.rx = re.compile('.*'.join(map(re.escape, terms)), re.IGNORECASE)
+
+    def grams(self):
+        return set().union(*map(grams, self.terms))
+
+    def narrows(self, previous):
+        """
+        A query narrows a previous one when it has at least as many terms
+        and each previous term is contained in the term at the same
+        position, e.g. "ab" -> "abc" or "ab" -> "ab cd". Its matches are
+        then a subset.
+        """
+        return (len(self.terms) >= len(previous) and
+                all(old in new for old, new in zip(previous, self.terms)))
+
+    def select(self, candidates, rows):
+        return [row for row in rows if self.rx.search(candidates[row])]
+
+    def rank(self, candidates, rows, cancelled):
+        return rows
+
+
+class FuzzyMatcher(ExactMatcher):
+    """
+    fzf-style matching: the characters of each term must appear in a row in
+    order but not necessarily together, and terms may come in any order.
+    Rows are scored with bonuses for word boundaries, consecutive characters
+    and ticket number prefixes, and only the best TOP_COUNT are kept.
+
+    score() defines the score of one line. select() computes the same for a
+    whole chunk of rows at once over the LineChars of the candidates and
+    keeps the scores for rank().
+    """
+
+    ranked = True
+    TOP_COUNT = 200
+    SCORE_MATCH = 16
+    SCORE_GAP_START = -3
+    SCORE_GAP_EXTENSION = -1
+    BONUS_BOUNDARY = 8
+    BONUS_CONSECUTIVE = 4
+    BONUS_FIRST_CHAR = 2
+    BONUS_TICKET = 1000
+
+    def __init__(self, terms):
+        self.terms = terms
+        self._scored = []
+
+    def grams(self):
+        # Terms are not substrings, every row is matched by select()
+        return set()
+
+    def narrows(self, previous):
+        return (len(self.terms) >= len(previous) and
+                all(is_subsequence(old, new)
+                    for old, new in zip(previous, self.terms)))
+
+    def select(self, candidates, rows):
+        if not self.terms:
+            return list(rows)
+        found, scores = self.scores(candidates.chars(), rows)
+        self._scored.append((found, scores))
+        return found.tolist()
+
+    def rank(self, candidates, rows, cancelled):
+        import numpy as np
+        if not self.terms:
+            return rows[:self.TOP_COUNT]
+        # Rows that matched an earlier search of the same query come before
+        # the ones selected here and are scored now
+        scored = list(self._scored)
+        known = len(rows) - sum(len(found) for found, _ in scored)
+        for chunk in chunks(rows[:known], FILTER_CHUNK_SIZE):
+            if cancelled():
+                return None
+            scored.append(self.scores(candidates.chars(), chunk))
+        if not rows:
+            return []
+        # Higher scores first, then earlier rows, as one sortable key
+        keys = np.concatenate([found - scores * 2 ** 32
+                               for found, scores in scored])
+        if len(keys) > self.TOP_COUNT:
+            keys = np.partition(keys, self.TOP_COUNT - 1)[:self.TOP_COUNT]
+        keys.sort()
+        return (keys % 2 ** 32).tolist()
+
+    def scores(self, chars, rows):
+        """
+        Return the rows that match and their scores as arrays. Each step of
+        score_term runs for all the rows at once: the next occurrence of a
+        character after a position in every row is looked up in its sorted
+        positions.
+        """
+        import numpy as np
+        if isinstance(rows, range):
+            rows = np.arange(rows.start, rows.stop, dtype=np.int64)
+        else:
+            rows = np.asarray(rows, np.int64)
+        starts = chars.offsets[rows]
+        ends = chars.offsets[rows + 1]
+        scores = np.zeros(len(rows), np.int64)
+        for term in self.terms:
+            positions = [chars.positions(char) for char in term]
+            if not all(len(found) for found in positions):
+                return rows[:0], scores[:0]
+            end = starts - 1
+            matched = np.ones(len(rows), bool)
+            for found in positions:
+                i = np.searchsorted(found, end + 1)
+                end = found.take(i, mode='clip')
+                matched &= (i < len(found)) & (end < ends)
+            rows, starts, ends, scores, end = (
+                rows[matched], starts[matched], ends[matched],
+                scores[matched], end[matched])
+            start = end + 1
+            for found in reversed(positions):
+                start = found[np.searchsorted(found, start) - 1]
+
+            position = start
+            previous = None
+            for i, found in enumerate(positions):
+                position = found[np.searchsorted(found, position)]
+                bonus = np.where(chars.boundaries(position, starts),
+                                 self.BONUS_BOUNDARY, 0)
+                if previous is None:
+                    chunk_bonus = bonus
+                else:
+                    consecutive = position == previous + 1
+                    chunk_bonus = np.where(
+                        consecutive, np.maximum(chunk_bonus, bonus), bonus)
+                    bonus = np.where(
+                        consecutive,
+                        np.maximum(chunk_bonus, self.BONUS_CONSECUTIVE), bonus)
+                    scores += np.where(
+                        consecutive, 0, self.SCORE_GAP_START +
+                        self.SCORE_GAP_EXTENSION * (position - previous - 2))
+                if i == 0:
+                    bonus = bonus * self.BONUS_FIRST_CHAR
+                scores += self.SCORE_MATCH + bonus
+                previous = position
+                position = position + 1
+
+            if term.isdigit():
+                scores += np.where(position - len(term) == starts,
+                                   self.BONUS_TICKET, 0)
+        return rows, scores
+
+    def score(self, line):
+        """
+        Score of a line that matches, see scores() for many rows at once.
+        """
+        lower = line.lower()
+        return sum(self.score_term(line, lower, term) for term in self.terms)
+
+    def score_term(self, line, lower, term):
+        # Find where the term ends at its first occurrence, then go back
+        # from there to find the shortest window that still contains it
+        end = -1
+        for char in term:
+            end = lower.find(char, end + 1)
+            if end < 0:
+                return 0
+        start = end + 1
+        for char in reversed(term):
+            start = lower.rfind(char, 0, start)
+
+        score = 0
+        previous = None
+        chunk_bonus = 0
+        position = start
+        for i, char in enumerate(term):
+            position = lower.find(char, position, end + 1)
+            bonus = 0
+            if position == 0 or not lower[position - 1].isalnum():
+                bonus = self.BONUS_BOUNDARY
+            if previous is not None and position == previous + 1:
+                # Characters in a run share the best bonus of the run
+                chunk_bonus = max(chunk_bonus, bonus)
+                bonus = max(chunk_bonus, self.BONUS_CONSECUTIVE)
+            else:
+                chunk_bonus = bonus
+                if previous is not None:
+                    gap = position - previous - 1
+                    score += (self.SCORE_GAP_START +
+                              self.SCORE_GAP_EXTENSION * (gap - 1))
+            if i == 0:
+                bonus *= self.BONUS_FIRST_CHAR
+            score += self.SCORE_MATCH + bonus
+            previous = position
+            position += 1
+
+        if term.isdigit() and lower.startswith(term):
+            score += self.BONUS_TICKET
+        return score
+
+
+MATCHERS = {'exact': ExactMatcher, 'fuzzy': FuzzyMatcher}
+
+
+class IncrementalSearch:
+    """
+    Keeps a stack of previous queries with their accepted rows and the
+    number of rows they were searched in. A query that narrows the one on
+    top only re-checks those rows and any added since, and going back to a
+    query on the stack (backspace) is answered without searching.
+    """
+
+    def __init__(self, index, matcher=ExactMatcher):
+        self._index = index
+        self._matcher = matcher
+        self._stack = []
+        self.ranked = matcher.ranked
+
+    def extend(self, lines):
+        self._index.extend(lines)
+        return len(self._index)
+
+    def search(self, text, cancelled=lambda: False, more=False):
+        """
+        Generate the result rows in chunks. Unranked matches are produced
+        as they are found, ranked ones once at the end. The search stops
+        between chunks once cancelled() is true, and a search that is not
+        run to completion is not pushed to the stack.
+
+        With `more`, the query was searched before and only what the rows
+        added since change is produced: new unranked matches, or the ranked
+        matches again.
+        """
+        terms = [term.lower() for term in text.split()]
+        matcher = self._matcher(terms)
+        while self._stack and not matcher.narrows(self._stack[-1][0]):
+            self._stack.pop()
+        count = len(self._index)
+        known = []
+        rows = None
+        if self._stack:
+            previous, selected, ranked, searched = self._stack[-1]
+            if previous == terms:
+                if searched == count:
+                    if not more:
+                        yield ranked
+                    return
+                # The same query, only the added rows are new
+                self._stack.pop()
+                known = selected
+                rows = self._added(matcher, searched)
+            elif len(selected) < searched:
+                rows = selected
+                if searched < count:
+                    rows = rows + list(self._added(matcher, searched))
+        if rows is None:
+            rows = self._added(matcher, 0)
+        if known and not matcher.ranked and not more:
+            yield known
+        selected = list(known)
+        for chunk in chunks(rows, FILTER_CHUNK_SIZE):
+            if cancelled():
+                return
+            found = matcher.select(self._index, chunk)
+            selected.extend(found)
+            if found and not matcher.ranked:
+                yield found
+        ranked = matcher.rank(self._index, selected, cancelled)
+        if ranked is None:
+            return
+        self._stack.append((terms, selected, ranked, count))
+        del self._stack[:-SEARCH_HISTORY]
+        if matcher.ranked:
+            yield ranked
+
+    def _added(self, matcher, start):
+        # Rows from `start` on that can match, by trigrams when there are any
+        rows = self._index.candidates(matcher.grams())
+        if rows is None:
+            return range(start, len(self._index))
+        return rows[bisect_left(rows, start):]
+
+
+class AsyncFilter(QObject):
+    """
+    Runs IncrementalSearch on a worker thread. A new query supersedes the one
+    in flight, which stops at its next chunk. Results are delivered through
+    `ready` as (generation, rows, first) where the first chunk of a query
+    replaces the previous results and the following ones are appended.
+    `done` is emitted when a query has been searched to the end.
+
+    Candidates added with extend() are indexed on the worker too, `extended`
+    reports the new count before the last query is run on the added rows.
+    Queries go ahead of candidates waiting to be indexed, so typing is not
+    held up while a large list loads.
+    """
+    ready = pyqtSignal(int, object, bool)
+    done = pyqtSignal(int)
+    extended = pyqtSignal(int, bool)
+
+    def __init__(self, search):
+        super(AsyncFilter, self).__init__()
+        self.search = search
+        self.generation = 0
+        self.queue = PriorityQueue()
+        self.order = count()
+        Thread(target=self._serve, daemon=True).start()
+
+    def add(self, text):
+        self.generation += 1
+        self.queue.put((0, next(self.order),
+                        ('search', self.generation, text)))
+        return self.generation
+
+    def extend(self, lines, last=False):
+        self.queue.put((1, next(self.order), ('extend', lines, last)))
+
+    def _serve(self):
+        searched = None
+        while True:
+            _, _, (kind, *message) = self.queue.get()
+            if kind == 'extend':
+                lines, last = message
+                self.extended.emit(self.search.extend(lines), last)
+                if searched is None or searched[0] != self.generation:
+                    continue
+                generation, text = searched
+                more = True
+            else:
+                generation, text = message
+                more = False
+            cancelled = lambda: generation != self.generation
+            # Rows found in added candidates are appended to the results,
+            # unless they are ranked and come all at once
+            first = not more or self.search.ranked
+            for rows in self.search.search(text, cancelled, more):
+                self.ready.emit(generation, rows, first)
+                first = False
+            if cancelled():
+                logging.info('cancelled pattern: %s', text)
+                continue
+            if first and not more:
+                self.ready.emit(generation, [], True)
+            searched = (generation, text)
+            self.done.emit(generation)
+
+
+class ExactMultipartFilterModel(QAbstractProxyModel):
     """
     This model is used to filter view by a pattern that contains words,
-    separated with spaces. Each word of the pattern should be present in a row.
+    separated with spaces. Each word of the pattern should be present in a row,
+    how exactly is up to the matcher (ExactMatcher or FuzzyMatcher). Rows are
+    looked up in a CandidateIndex off the GUI thread by AsyncFilter and
+    arrive in chunks: the first one replaces the model contents in one reset,
+    later ones are collected and appended every FLUSH_INTERVAL ms, because
+    every insert makes the completer remap all rows.
     """
+    filtered = pyqtSignal(bool)
+    loaded = pyqtSignal(int, bool)
 
     def __init__(self, parent):
         super(ExactMultipartFilterModel, self).__init__(parent)
-        self._filteringRegExp = None
+        self._filter = None
+        self._generation = None
+        self._rows = []
+        self._pending = []
+        self._positions = None
+        self._flushTimer = QTimer(self)
+        self._flushTimer.setInterval(FLUSH_INTERVAL)
+        self._flushTimer.timeout.connect(self.flush)
+
+    def setCandidateIndex(self, index, matcher=ExactMatcher):
+        self._filter = AsyncFilter(IncrementalSearch(index, matcher))
+        self._filter.ready.connect(self.onFilterReady)
+        self._filter.done.connect(self.onFilterDone)
+        self._filter.extended.connect(self.onCandidatesAdded)
+
+    def addCandidates(self, lines, last=False):
+        # Called from the thread that reads the candidates
+        self._filter.extend(lines, last)
+
+    def onCandidatesAdded(self, count, last):
+        self.sourceModel().grow(count)
+        self.loaded.emit(count, last)
 
     def setFilterString(self, text):
-        # pattern = text.toLower().replace(QRegExp(r"\s+"), ".*")
-        pattern = RX_SPACES.sub('.*', text)
-        # pattern = text.lower().replace(QRegExp(r"\s+"), ".*")
-        # self._filteringRegExp = QRegExp(pattern, Qt.CaseInsensitive)
-        self._filteringRegExp = re.compile(pattern, re.IGNORECASE)
-        logging.info('new pattern: %s', pattern)
-        self.invalidateFilter()
-
-    def filterAcceptsRow(self, intSourceRow, sourceParent):
-        if self._filteringRegExp is None:
-            return False
+        if self._filter is not None:
+            logging.info('new pattern: %s', text)
+            self._generation = self._filter.add(text)
+
+    def onFilterReady(self, generation, rows, first):
+        if generation != self._generation:
+            return
+        if first:
+            self._pending = []
+            self.beginResetModel()
+            self._rows = list(rows)
+            self._positions = None
+            self.endResetModel()
+            self.filtered.emit(True)
+            self._flushTimer.start()
+        else:
+            self._pending.extend(rows)
+
+    def onFilterDone(self, generation):
+        if generation == self._generation:
+            self._flushTimer.stop()
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        end = len(self._rows)
+        self.beginInsertRows(QModelIndex(), end, end + len(self._pending) - 1)
+        self._rows.extend(self._pending)
+        self._pending = []
+        self._positions = None
+        self.endInsertRows()
+        self.filtered.emit(False)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 1
 
-        index0 = self.sourceModel().index(intSourceRow, 0, sourceParent)
-        data = self.sourceModel().data(index0)
-        # logging.info('data line: %s', data)
-        # data = self.sourceModel().data(index0).toString()
-        # return data.contains(self._filteringRegExp)
-        found = self._filteringRegExp.search(data) != None
-        # if found:
-        # logging.info('found: %s', data)
-        return found
+    def index(self, row, column, parent=QModelIndex()):
+        if parent.isValid() or column != 0 or not 0 <= row < len(self._rows):
+            return QModelIndex()
+        return self.createIndex(row, column)
+
+    def parent(self, index):
+        return QModelIndex()
+
+    def mapToSource(self, proxyIndex):
+        if not proxyIndex.isValid() or self.sourceModel() is None:
+            return QModelIndex()
+        return self.sourceModel().index(self._rows[proxyIndex.row()], 0)
+
+    def mapFromSource(self, sourceIndex):
+        if not sourceIndex.isValid():
+            return QModelIndex()
+        if self._positions is None:
+            self._positions = {row: i for i, row in enumerate(self._rows)}
+        position = self._positions.get(sourceIndex.row())
+        if position is None:
+            return QModelIndex()
+        return self.createIndex(position, 0)
 
 
 class MainWindow(QWidget):
-    def __init__(self, app):
+    def __init__(self, app, candidates, matcher=ExactMatcher, resident=False):
         super().__init__()
 
         self.ticket = None
         self.app = app
+        self.resident = resident
+        self.reply = None
 
         self.comboxBox = QComboBox(self)
         self.comboxBox.setEditable(True)
         # self.comboxBox.setCom
-        self.comboxBox.addItems(slurp_lines(CANDIDATES_FILENAME))
+        # Set the font before the model, a font change walks all the rows
+        font = QFont()
+        font.setPointSize(font.pointSize() + ADD_TO_FONT_SIZE)
+        self.comboxBox.setFont(font)
+        self.comboxBox.setModel(CandidateListModel(candidates, self))
+        self.comboxBox.setSizeAdjustPolicy(
+            QComboBox.AdjustToMinimumContentsLengthWithIcon)
+        self.comboxBox.view().setUniformItemSizes(True)
+        self.comboxBox.setInsertPolicy(QComboBox.NoInsert)
         self.comboxBox.setMaximumWidth(WINDOW_WIDTH)
         self.comboxBox.setCurrentText('')
 
@@ -90,17 +1098,17 @@ class MainWindow(QWidget):
 
         self.custom_filter = ExactMultipartFilterModel(self)
         self.custom_filter.setSourceModel(self.comboxBox.model())
+        self.custom_filter.setCandidateIndex(candidates, matcher)
         self.comboxBox.lineEdit().textEdited.connect(
             self.custom_filter.setFilterString)
-
-        font = QFont()
-        font.setPointSize(font.pointSize() + ADD_TO_FONT_SIZE)
-        self.comboxBox.setFont(font)
+        self.custom_filter.filtered.connect(self.onFiltered)
+        self.custom_filter.loaded.connect(self.onLoaded)
 
         self.completer = QCompleter(self.comboxBox.model(), self.comboxBox)
         self.completer.setModel(self.custom_filter)
         self.completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
         self.completer.popup().setFont(font)
+        self.completer.popup().setUniformItemSizes(True)
 
         self.comboxBox.setCompleter(self.completer)
 
@@ -111,14 +1119,85 @@ class MainWindow(QWidget):
         mainLayout.setContentsMargins(0, 0, 0, 0)
         # mainLayout.setMar
         mainLayout.addWidget(self.comboxBox)
+
+        # Busy indicator while candidates are streamed in
+        self.progress = QProgressBar(self)
+        self.progress.setRange(0, 0)
+        self.progress.setTextVisible(False)
+        self.progress.setMaximumHeight(PROGRESS_HEIGHT)
+        self.progress.hide()
+        mainLayout.addWidget(self.progress)
         self.setLayout(mainLayout)
 
         self.setWindowTitle('CompleteBox')
         self.resize(WINDOW_WIDTH, WINDOW_HEIGHT)
         self.setWindowIcon(QIcon(ICON_FILENAME))
 
+        self.center()
+        if not resident:
+            self.show()
+
+    def readCandidates(self, source):
+        """
+        Stream candidates from a file object such as stdin, or from the
+        Popen of a command, into the list while the window is in use.
+        """
+        self.progress.show()
+        # QComboBox selects the first row when rows come into an empty model,
+        # replacing what was typed, unless it has a placeholder text
+        self.comboxBox.setPlaceholderText('loading')
+        Thread(target=read_candidates, daemon=True,
+               args=(source, self.custom_filter.addCandidates)).start()
+
+    def onLoaded(self, count, last):
+        if last:
+            logging.info('loaded %d candidates', count)
+            self.progress.hide()
+            self.setWindowTitle('CompleteBox')
+        else:
+            self.setWindowTitle('CompleteBox ({0} loading)'.format(count))
+
+    def summon(self, reply):
+        if self.reply is not None:
+            self.reply.put(None)
+        self.reply = reply
+        self.ticket = None
         self.center()
         self.show()
+        self.raise_()
+        self.activateWindow()
+        self.comboxBox.setFocus()
+
+    def finish(self, ticket):
+        self.ticket = ticket
+        # An editable combo box looks its text up in every row when it loses
+        # focus, an empty text skips that
+        self.comboxBox.setCurrentText('')
+        if not self.resident:
+            self.close()
+            return
+        self.hide()
+        if self.reply is not None:
+            self.reply.put(ticket)
+            self.reply = None
+
+    def closeEvent(self, e):
+        if self.resident:
+            e.ignore()
+            self.finish(None)
+
+    def onFiltered(self, first):
+        # Results arrive after the completer has handled the keystroke, so
+        # show or hide the popup for them here. Rows appended to empty
+        # results, e.g. from streamed candidates, show it as well.
+        if not self.isVisible():
+            return
+        if not first and self.completer.popup().isVisible():
+            return
+        if self.custom_filter.rowCount():
+            self.completer.complete()
+        else:
+            self.completer.popup().hide()
 
     def center(self):
         qr = self.frameGeometry()
@@ -131,21 +1210,12 @@ class MainWindow(QWidget):
 
     def keyPressEvent(self, e):
         if e.key() == Qt.Key_Escape:
-            self.close()
+            self.finish(None)
         elif e.key() == Qt.Key_Return:
-            self.ticket = self.extractTicketNumber()
-            logging.info('ticket: %s', self.ticket)
-            self.close()
-
-
-class XdoTool:
-    def get_active_window(self):
-        output = check_output(['xdotool', 'getactivewindow'])
-        return output.decode('utf8').strip()
+            ticket = self.extractTicketNumber()
+            logging.info('ticket: %s', ticket)
+            self.finish(ticket)
 
-    def send_text(self, window, text):
-        check_output(['xdotool', 'windowfocus',
-                      '--sync', window, 'type', text])
 
 # TODO:
 # * open ticket in xdg-open when pressed Ctrl-Enter
@@ -154,15 +1224,85 @@ class XdoTool:
 # * put window above center vertically, not in the middle
 
 
+class Resident(QObject):
+    """
+    Hands summons from the Daemon server thread to the GUI thread and types
+    the selected ticket into the target window once the window is done.
+    """
+    summoned = pyqtSignal(object)
+
+    def __init__(self, daemon, xdo):
+        super(Resident, self).__init__()
+        self.xdo = xdo
+        daemon.observe(self.on_summon)
+
+    def on_summon(self, window):
+        if not window:
+            window = self.xdo.get_active_window()
+        logging.info('summoned for window >%s<', window)
+        reply = Queue()
+        self.summoned.emit(reply)
+        ticket = reply.get()
+        if ticket:
+            logging.info('sending to window %s: %s', window, ticket)
+            self.xdo.send_text(window, ticket)
+        return window, ticket
+
+
 if __name__ == '__main__':
+    if args.compile:
+        lines = slurp_lines(args.candidates)
+        CandidateStore.build(lines, args.store)
+        logging.info('compiled %d candidates into %s', len(lines), args.store)
+        sys.exit()
+
     logging.info('START')
 
-    xdo = XdoTool()
+    if args.mode == 'fuzzy' and find_spec('numpy') is None:
+        logging.warning('numpy is not available, falling back to exact '
+                        'matching')
+        args.mode = 'exact'
+
+    # Streamed candidates start out empty and are added as they are read.
+    # So is a TSV without a store, indexing it takes seconds for large lists
+    # and is done on the filter thread while the window is in use.
+    source = None
+    candidates = None
+    if args.command:
+        source = Popen(args.command, shell=True, stdout=PIPE)
+    elif args.candidates == '-':
+        source = sys.stdin
+    else:
+        candidates = open_store(args.candidates, args.store)
+        if candidates is None:
+            logging.info('loading candidates %s (run with --compile to build '
+                         'a store)', args.candidates)
+            source = open(args.candidates, 'rb')
+    if candidates is None:
+        candidates = CandidateIndex([])
+
+    xdo = make_xdo(args.xdo)
+    if args.daemon:
+        if not daemon.start():
+            logging.info('resident instance is already running')
+            sys.exit()
+        app = QApplication(sys.argv)
+        app.setQuitOnLastWindowClosed(False)
+        window = MainWindow(app, candidates, MATCHERS[args.mode],
+                            resident=True)
+        if source is not None:
+            window.readCandidates(source)
+        resident = Resident(daemon, xdo)
+        resident.summoned.connect(window.summon)
+        sys.exit(app.exec())
+
     active_window = xdo.get_active_window()
     logging.info('active window: >%s<', active_window)
 
     app = QApplication(sys.argv)
-    window = MainWindow(app)
+    window = MainWindow(app, candidates, MATCHERS[args.mode])
+    if source is not None:
+        window.readCandidates(source)
     result = app.exec()
 
     logging.info('DONE: %s', window.ticket)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from httpx import AsyncClient, Limits
+
+
+async def lookup(client, url, etags, latencies, statuses):
+    # Like GoldenDict, revalidate a page that was already fetched
+    headers = {'Accept-Encoding': 'gzip'}
+    if url in etags:
+        headers['If-None-Match'] = etags[url]
+    started = time.monotonic()
+    try:
+        response = await client.get(url, headers=headers)
+    except Exception as e:
+        statuses[type(e).__name__] += 1
+        return
+    latencies.append(time.monotonic() - started)
+    statuses[response.status_code] += 1
+    if 'ETag' in response.headers:
+        etags[url] = response.headers['ETag']
+
+
+async def run(args):
+    urls = ['{0}/ordbok/inflect/{1}'.format(args.url, x) for x in args.words]
+    etags = {}
+    latencies = []
+    statuses = Counter()
+    slots = asyncio.Semaphore(args.concurrency)
+    async def one(url):
+        async with slots:
+            await lookup(client, url, etags if args.revalidate else {}, latencies, statuses)
+    limits = Limits(max_connections=args.concurrency)
+    async with AsyncClient(limits=limits, timeout=args.timeout) as client:
+        started = time.monotonic()
+        await asyncio.gather(*[one(urls[i % len(urls)]) for i in range(args.requests)])
+        elapsed = time.monotonic() - started
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else 0
+    print('{0} requests in {1:.2f} s, {2:.0f} requests/s, concurrency {3}'.format(
+        args.requests, elapsed, args.requests / elapsed, args.concurrency))
+    print('latency p50 {0:.1f} ms, p90 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms'.format(
+        percentile(0.5), percentile(0.9), percentile(0.99), percentile(1)))
+    print('status', ', '.join('{0}: {1}'.format(k, v) for k, v in sorted(statuses.items(), key=str)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='load-test the GoldenDict proxy')
+    parser.add_argument('words', nargs='+', help='words to look up in turn')
+    parser.add_argument('--url', default='http://localhost:5660')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--revalidate', action='store_true', help='send If-None-Match with known ETags')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
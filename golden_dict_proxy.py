@@ -1,32 +1,22 @@
 #!/usr/bin/env python3
 
-import logging
-from threading import Thread
+import argparse
 
-from ordbok_uib_no import CachedHttpClient, HttpClient
+from ordbok_uib_no import (CachedHttpClient, GoldenDictProxy, HttpClient,
+                           SqliteStore, CACHE_FILENAME)
 
-from uvicorn import run as uvicorn_run
-from fastapi import FastAPI
-proxy_app = FastAPI()
 
-FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
-logging.basicConfig(format=FORMAT, level=logging.DEBUG)
-
-class GoldenDictProxy:
-    def __init__(self, client, host, port):
-        self.client = client
-        self.host = host
-        self.port = port
-    def serve(self):
-        logging.info('Starting GoldenDictProxy on %s:%s', self.host, self.port)
-        uvicorn_run('golden_dict_proxy:proxy_app', host=self.host, port=self.port, log_level='info')
-    @proxy_app.get('/ordbok/inflect/{word}')
-    def ordbok_inflect(self, word):
-        logging.info('Inflect: %s', word)
+def parse_args():
+    parser = argparse.ArgumentParser(description='serve ordbok.uib.no articles to GoldenDict')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5660)
+    parser.add_argument('--store', default=CACHE_FILENAME, help='SQLite cache file')
+    parser.add_argument('--origin', help='fetch from another server, e.g. http://localhost:5670 of ordbok_stub.py')
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    client = CachedHttpClient(HttpClient(), 'cache')
-    golden_dict_proxy = GoldenDictProxy(client, 'localhost', 5660)
+    args = parse_args()
+    client = CachedHttpClient(HttpClient(origin=args.origin), SqliteStore(args.store))
+    golden_dict_proxy = GoldenDictProxy(client, args.host, args.port)
     golden_dict_proxy.serve()
-    #Thread(target=golden_dict_proxy.serve, daemon=True).start()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+from os.path import dirname, getsize, join
+
+from ordbok_uib_no import (Article, CachedHttpClient, FileStore, Inflection,
+                           Lexicon, PartOfSpeech, SqliteStore, CACHE_DIRNAME,
+                           CACHE_FILENAME, LEXICON_FILENAME)
+
+FIXTURES_DIRNAME = join(dirname(__file__) or '.', 'fixtures')
+
+
+def migrate(source, target):
+    count = 0
+    for key in source.keys():
+        entry = source.get(key)
+        if entry is None:
+            logging.warning('skipping unreadable entry: %s', key)
+            continue
+        target.put(key, entry)
+        count += 1
+    target.flush()
+    return count
+
+
+def soup_parts(html):
+    # Parts of speech as Article found them with BeautifulSoup, the
+    # reference for extract_parts in fixtures/ordbok_parts.json
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, features='lxml')
+    return [[x.text, x.get('onclick', '')]
+            for x in soup.find_all('span', {'class': 'oppsgramordklasse'})]
+
+
+def record_fixtures(store, words, fixtures_dirname):
+    """
+    Copy the cached article pages of `words` and the inflection pages they
+    refer to into fixtures, and add their parts to ordbok_parts.json.
+    """
+    keys = CachedHttpClient(None, store)
+
+    def copy(url, filename):
+        entry = store.get(keys.get_key(url))
+        if entry is None:
+            logging.warning('not in the cache: %s', url)
+            return None
+        with open(join(fixtures_dirname, filename), 'w', encoding='utf-8') as f:
+            f.write(entry.content)
+        return entry.content
+
+    parts_filename = join(fixtures_dirname, 'ordbok_parts.json')
+    with open(parts_filename, encoding='utf-8') as f:
+        expected = json.load(f)
+    for word in words:
+        html = copy(Article.get_url(word), 'ordbok_{0}.html'.format(word))
+        if html is None:
+            continue
+        expected[word] = soup_parts(html)
+        for _, onclick in expected[word]:
+            lid = PartOfSpeech('', onclick).lid
+            if lid:
+                copy(Inflection.get_url(lid), 'paradigme_{0}.html'.format(lid))
+    with open(parts_filename, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(expected, indent=2, sort_keys=True, ensure_ascii=False) + '\n')
+    return sorted(expected)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ordbok_uib_no cache maintenance')
+    parser.add_argument('--store', default=CACHE_FILENAME, help='SQLite cache file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help='import the bz2 file tree into the store')
+    migrate_parser.add_argument('--dirname', default=CACHE_DIRNAME,
+                                help='bz2 cache directory relative to ordbok_uib_no.py')
+    commands.add_parser('stats', help='show the number and size of entries')
+    lexicon_parser = commands.add_parser('lexicon', help='rebuild the suggestion lexicon from the store')
+    lexicon_parser.add_argument('--filename', default=LEXICON_FILENAME, help='lexicon file')
+    fixture_parser = commands.add_parser('fixture', help='record cached article pages into the fixtures')
+    fixture_parser.add_argument('words', nargs='+', help='words whose articles are recorded')
+    fixture_parser.add_argument('--dirname', default=FIXTURES_DIRNAME, help='fixtures directory')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    store = SqliteStore(args.store)
+    if args.command == 'migrate':
+        count = migrate(FileStore(args.dirname), store)
+        logging.info('migrated %d entries into %s', count, args.store)
+    elif args.command == 'stats':
+        count, size = store.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(content)), 0) FROM cache').fetchone()
+        print('{0}: {1} entries, {2} characters, {3} bytes on disk'.format(
+            args.store, count, size, getsize(args.store)))
+    elif args.command == 'lexicon':
+        lexicon = Lexicon(args.filename)
+        lexicon.seed(store)
+        lexicon.save()
+        print(lexicon)
+    elif args.command == 'fixture':
+        words = record_fixtures(store, args.words, args.dirname)
+        print('{0}/ordbok_parts.json: {1}'.format(args.dirname, ', '.join(words)))
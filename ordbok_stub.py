@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import random
+import re
+import time
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import exists, join
+from urllib.parse import unquote
+
+from ordbok_uib_no import CachedHttpClient, SqliteStore, CACHE_FILENAME
+
+ORIGIN = 'https://ordbok.uib.no'
+# Recorded pages in fixtures/ are named after the parameter that selects them
+FIXTURES = [
+    (re.compile(r'ordbok\.cgi\?.*\bOPP=([^&]*)'), 'ordbok_{0}.html'),
+    (re.compile(r'bob_hente_paradigme\.cgi\?.*\blid=(\d+)'), 'paradigme_{0}.html'),
+    (re.compile(r'lage_ordliste\w*\.cgi\?.*\bquery=([^&]*)'), 'suggestions_{0}.txt'),
+]
+
+
+class StorePages:
+    def __init__(self, filename):
+        self.store = SqliteStore(filename)
+        self.keys = CachedHttpClient(None, self.store)
+
+    def get(self, path):
+        entry = self.store.get(self.keys.get_key(ORIGIN + path))
+        return entry.content if entry else None
+
+
+class FixturePages:
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def get(self, path):
+        for pattern, template in FIXTURES:
+            m = pattern.search(path)
+            if m:
+                filename = join(self.dirname, template.format(m.group(1)))
+                if exists(filename):
+                    with open(filename, encoding='utf-8') as f:
+                        return f.read()
+        return None
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Replays recorded pages of ordbok.uib.no, so that the dictionary can be
+    exercised without the network. Every response can be delayed and a
+    share of them fail with 503 to exercise retries.
+    """
+    daemon_threads = True
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            server = self.server
+            time.sleep(server.latency)
+            if random.random() < server.fail_rate:
+                return self.reply(503)
+            content = server.pages.get(unquote(self.path))
+            if content is None:
+                return self.reply(404)
+            body = content.encode('utf-8')
+            etag = '"{0}"'.format(md5(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                return self.reply(304, headers={'ETag': etag})
+            self.reply(200, body, {'ETag': etag,
+                                   'Content-Type': 'text/html; charset=utf-8'})
+
+        def reply(self, status, body=b'', headers={}):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug('stub: ' + format, *args)
+
+    def __init__(self, pages, host, port, latency=0, fail_rate=0):
+        super().__init__((host, port), StubServer.RequestHandler)
+        self.pages = pages
+        self.latency = latency
+        self.fail_rate = fail_rate
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='replay recorded ordbok.uib.no pages')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5670)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--store', default=CACHE_FILENAME, help='SQLite cache file to replay')
+    source.add_argument('--fixtures', help='directory of recorded pages, e.g. fixtures')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--fail-rate', type=float, default=0, help='share of responses that fail with 503')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    pages = FixturePages(args.fixtures) if args.fixtures else StorePages(args.store)
+    server = StubServer(pages, args.host, args.port, args.latency, args.fail_rate)
+    logging.info('serving %s on http://%s:%d', args.fixtures or args.store, args.host, args.port)
+    server.serve_forever()
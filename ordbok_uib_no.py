@@ -1,77 +1,159 @@
 #!/usr/bin/env python3
 
+# As early as possible, time to interactive is measured from here
+from time import perf_counter
+STARTED = perf_counter()
+
+import argparse
 import sys
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.request import urlopen
-from threading import Thread
-from queue import Queue
+from os import environ, getuid, unlink
+from os.path import join
+from socket import AF_UNIX, SOCK_STREAM, socket
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from tempfile import gettempdir
+from threading import Lock, Thread
 
 
 class WatchDog:
-    class Server(HTTPServer):
-        class RequestHandler(BaseHTTPRequestHandler):
-            def __init__(self, request, client_address, server):
-                BaseHTTPRequestHandler.__init__(self, request, client_address, server)
-                self.server = server
-            def do_POST(self):
-                print('showing main window')
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b'OK')
-                self.server.on_show()
-        def __init__(self, host, port, on_show):
-            HTTPServer.__init__(self, (host, port), WatchDog.Server.RequestHandler)
-            self.host = host
-            self.port = port
-            self.on_show = on_show
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
+    """
+    Single-instance channel of ordbok_uib_no. The first instance listens on a
+    Unix socket, a later one sends it commands, one per line, and reads back
+    a line of "ok" or "error <reason>" for each: "show" raises the window,
+    "lookup <word>" raises it looking the word up and "quit" exits.
+    Commands that come before observe() are kept and run once it is called.
+    """
+
+    COMMANDS = ('show', 'lookup', 'quit')
+
+    class Server(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+        class RequestHandler(StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    command, _, argument = line.decode('utf8').strip().partition(' ')
+                    reply = self.server.on_command(command, argument.strip())
+                    self.wfile.write('{0}\n'.format(reply).encode('utf8'))
+
+        def __init__(self, filename, on_command):
+            UnixStreamServer.__init__(self, filename,
+                                      WatchDog.Server.RequestHandler)
+            self.on_command = on_command
+
+    def __init__(self, filename):
+        self.filename = filename
         self.server = None
-        self.thread = None
-        self.on_show_callback = None
+        self.on_command_callback = None
+        self.early = []
+        self.lock = Lock()
+
     def start(self):
         try:
-            self.server = WatchDog.Server(self.host, self.port, self._call_on_show)
-            self.thread = Thread(target=self.server.serve_forever, daemon=True)
-            self.thread.start()
+            self.server = WatchDog.Server(self.filename, self._call_on_command)
+        except OSError:
+            if self.running():
+                return False
+            # Stale socket left by an instance that did not exit cleanly
+            unlink(self.filename)
+            self.server = WatchDog.Server(self.filename, self._call_on_command)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return True
+
+    def stop(self):
+        self.server.server_close()
+        unlink(self.filename)
+
+    def running(self):
+        try:
+            with socket(AF_UNIX, SOCK_STREAM) as client:
+                client.connect(self.filename)
             return True
         except OSError:
             return False
-    def show(self):
-        print('Watchdog already running, showing previous instance')
-        with urlopen(self.get_show_url(), b'') as r:
-            r.read()
-    def get_show_url(self):
-        return 'http://{0}:{1}/'.format(self.host, self.port)
-    def _call_on_show(self):
-        self.on_show_callback()
-    def observe(self, on_show):
-        self.on_show_callback = on_show
-
-
-HOST = 'localhost'
-PORT = 5650
-dog = WatchDog(HOST, PORT)
-if not dog.start():
-    dog.show()
-    sys.exit()
 
+    def send(self, command, argument=''):
+        # Newlines would end the command early, a word is sent as one line
+        line = ' '.join([command] + argument.split())
+        with socket(AF_UNIX, SOCK_STREAM) as client:
+            client.connect(self.filename)
+            client.sendall('{0}\n'.format(line).encode('utf8'))
+            return client.makefile('rb').readline().decode('utf8').rstrip('\n')
+
+    def _call_on_command(self, command, argument):
+        if command not in WatchDog.COMMANDS:
+            return 'error unknown command "{0}"'.format(command)
+        if (command == 'lookup') != bool(argument):
+            return 'error "{0}" takes {1}'.format(
+                command, 'a word' if command == 'lookup' else 'no argument')
+        with self.lock:
+            if self.on_command_callback is None:
+                # The window is still being set up
+                self.early.append((command, argument))
+                return 'ok'
+        self.on_command_callback(command, argument)
+        return 'ok'
+
+    def observe(self, on_command):
+        with self.lock:
+            self.on_command_callback = on_command
+            early, self.early = self.early, []
+        for command, argument in early:
+            on_command(command, argument)
+
+
+SOCKET_FILENAME = join(environ.get('XDG_RUNTIME_DIR') or gettempdir(),
+                       'ordbok_uib_no-{0}.sock'.format(getuid()))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ordbok.uib.no dictionary')
+    parser.add_argument('--lookup', metavar='WORD', help='word to look up, in the running instance if there is one')
+    parser.add_argument('--quit', action='store_true', help='quit the running instance')
+    # The rest is for Qt, e.g. -platform offscreen. The word is an option, a
+    # positional one would take the value of a Qt option.
+    return parser.parse_known_args()[0]
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dog = WatchDog(SOCKET_FILENAME)
+    if args.quit:
+        if not dog.running():
+            sys.exit('ordbok_uib_no is not running')
+        sys.exit(0 if dog.send('quit') == 'ok' else 1)
+    if not dog.start():
+        reply = dog.send('lookup', args.lookup) if args.lookup else dog.send('show')
+        if reply != 'ok':
+            sys.exit(reply)
+        sys.exit()
+
+import atexit
+import bisect
 import logging
 import re
 import bz2
-from os import makedirs
-from os.path import dirname, exists, normpath
-from urllib.parse import urlparse
-from json import loads
+import gzip
+import sqlite3
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import nullcontext
+from hashlib import md5
+from html import unescape
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import close, makedirs, replace, utime, walk
+from os.path import dirname, getmtime, join, normpath, relpath
+from tempfile import mkstemp
+from itertools import count
+from queue import PriorityQueue
+from threading import Timer, current_thread
+from urllib.parse import urlparse, urlunparse
+from json import dumps, loads
 
-from requests import get
-from bs4 import BeautifulSoup
 
 from PyQt5.QtWidgets import (QApplication, QComboBox, QVBoxLayout,
                              QWidget, QDesktopWidget, QCompleter, QTextBrowser,
                              QSystemTrayIcon, QMenu, QAction)
-from PyQt5.QtGui import QIcon, QFont
+from PyQt5.QtGui import QIcon, QFont, QKeySequence, QTextDocument
 from PyQt5.QtCore import Qt, QTimer, QObject
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 
@@ -82,8 +164,61 @@ logging.basicConfig(format=FORMAT, level=logging.DEBUG)
 WINDOW_WIDTH = 1300
 WINDOW_HEIGHT = 800
 UPDATE_DELAY = 200
+CACHE_DIRNAME = 'cache'
+CACHE_FILENAME = dirname(__file__) + '/cache.sqlite'
+LEXICON_FILENAME = dirname(__file__) + '/lexicon.json'
+# The suggestion service returns at most this many words, a shorter list
+# holds every word that starts with the query
+SUGGESTIONS_LIMIT = 2000
+MEMORY_CACHE_SIZE = 32 * 1024 * 1024
+TEMP_PREFIX = '.tmp'
+PARSE_CACHE_SIZE = 256
+DAY = 24 * 60 * 60
+# How long a cached page is served without revalidation, first match wins
+CACHE_TTLS = [
+    (re.compile(r'lage_ordliste'), 1 * DAY),
+    (re.compile(r'bob_hente_paradigme'), 365 * DAY),
+    (re.compile(r'ordbok\.cgi'), 30 * DAY),
+]
+DEFAULT_CACHE_TTL = 30 * DAY
+REVALIDATE_WORKERS = 2
+# GoldenDictProxy port, ORDBOK_PROXY_PORT=0 runs without it
+PROXY_PORT = int(environ.get('ORDBOK_PROXY_PORT', 5660))
+PROXY_WORKERS = 8
+PROXY_CACHE_SIZE = 16 * 1024 * 1024
+# Seconds GoldenDict may reuse a page before revalidating it
+PROXY_MAX_AGE = 600
+BATCH_MAX_WORDS = 10000
+# Lookups in the window slower than this many seconds log a trace of the
+# stages that ran meanwhile, e.g. ORDBOK_SLOW_LOOKUP=0.5. Off when unset.
+SLOW_LOOKUP = float(environ.get('ORDBOK_SLOW_LOOKUP', 0)) or None
+TRACE_SIZE = 4096
+FETCH_WORKERS = 10
+# AsyncFetch priorities, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 1
+# Articles of the top suggestions fetched ahead of time, 0 disables it.
+# At most PREFETCH_WORKERS run at once, one starts every PREFETCH_INTERVAL
+# milliseconds and a session starts no more than PREFETCH_BUDGET.
+PREFETCH_COUNT = 3
+PREFETCH_WORKERS = 2
+PREFETCH_INTERVAL = 250
+PREFETCH_BUDGET = 500
+# Connect and read timeouts in seconds
+HTTP_TIMEOUT = (3.05, 10)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.3
+# One pooled connection for every thread that can fetch at once: AsyncFetch,
+# inflections of interactive, prefetched and GoldenDict proxy articles,
+# revalidation and the proxy itself
+HTTP_POOL_SIZE = (3 * FETCH_WORKERS + PREFETCH_WORKERS + REVALIDATE_WORKERS +
+                  PROXY_WORKERS)
 ICON_FILENAME = dirname(__file__) + '/ordbok_uib_no.png'
 ADD_TO_FONT_SIZE = 6
+# Laid out articles kept for going back, bounded by the length of their HTML.
+# A document takes about 20 times that in memory.
+DOCUMENT_CACHE_SIZE = 512 * 1024
+HISTORY_SIZE = 100
 
 PROXY_STYLE = '''
 <style>
@@ -122,35 +257,457 @@ td {
 }
 </style>
 '''
-HTML = '''
-<div id="41772"><table class="paradigmetabell" cellspacing="0" style="margin: 25px;"><tbody><tr><th class="nobgnola"><span class="grunnord">liv</span></th><th class="nola" colspan="2">Entall</th><th class="nola" colspan="2">Flertall</th></tr><tr><th class="nobg">&nbsp;&nbsp;</th><th>Ubestemt form</th><th>Bestemt form</th><th>Ubestemt form</th><th>Bestemt form</th></tr><tr id="41772_1"><td class="ledetekst">n1</td><td class="vanlig">et liv</td><td class="vanlig">livet</td><td class="vanlig">liv</td><td class="vanlig">liva</td></tr><tr id="41772_2"><td class="ledetekst">n1</td><td class="vanlig">et liv</td><td class="vanlig">livet</td><td class="vanlig">liv</td><td class="vanlig">livene</td></tr></tbody></table></div>
-'''
+
+HttpResponse = namedtuple('HttpResponse', 'status content etag last_modified')
+CacheEntry = namedtuple('CacheEntry', 'content fetched etag last_modified')
+
+
+class Span:
+    __slots__ = ('metrics', 'stage', 'detail', 'started')
+    def __init__(self, metrics, stage, detail):
+        self.metrics = metrics
+        self.stage = stage
+        self.detail = detail
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started,
+                             self.detail, self.started)
+
+
+class Metrics:
+    """
+    Latency histograms of the lookup stages, counters and gauges, rendered
+    in the Prometheus text format. While tracing, every observed span is
+    also kept in a ring buffer so that a slow lookup can be dumped with
+    what ran meanwhile. Disabled metrics hand out a shared no-op span.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10)
+    NO_SPAN = nullcontext()
+    def __init__(self, enabled=True, tracing=False, trace_size=TRACE_SIZE):
+        self.enabled = enabled
+        self.tracing = tracing
+        self.lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.spans = deque(maxlen=trace_size)
+
+    def span(self, stage, detail=''):
+        if not self.enabled:
+            return Metrics.NO_SPAN
+        return Span(self, stage, detail)
+
+    def observe(self, stage, seconds, detail='', started=None):
+        if not self.enabled:
+            return
+        i = bisect.bisect_left(Metrics.BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0] * (len(Metrics.BUCKETS) + 3)
+            histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+        if self.tracing:
+            if started is None:
+                started = time.perf_counter() - seconds
+            self.spans.append((started, seconds, stage, detail, current_thread().name))
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def dump(self, title, since):
+        spans = sorted(x for x in list(self.spans) if x[0] >= since)
+        lines = ['{0:8.1f} ms {1:8.1f} ms  {2:<14} {3:<16} {4}'.format(
+            (started - since) * 1000, seconds * 1000, stage, thread, detail)
+            for started, seconds, stage, detail, thread in spans]
+        logging.warning('%s, %d spans (start, duration, stage, thread, detail):\n%s',
+                        title, len(lines), '\n'.join(lines))
+
+    def render(self):
+        label = lambda labels: '{' + ','.join('{0}="{1}"'.format(k, v) for k, v in labels) + '}' if labels else ''
+        with self.lock:
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = ['# TYPE ordbok_stage_seconds histogram']
+        for stage, histogram in sorted(histograms.items()):
+            total = 0
+            for bound, count in zip(Metrics.BUCKETS + ('+Inf',), histogram):
+                total += count
+                lines.append('ordbok_stage_seconds_bucket{{stage="{0}",le="{1}"}} {2}'.format(stage, bound, total))
+            lines.append('ordbok_stage_seconds_sum{{stage="{0}"}} {1}'.format(stage, histogram[-2]))
+            lines.append('ordbok_stage_seconds_count{{stage="{0}"}} {1}'.format(stage, histogram[-1]))
+        for name in sorted({name for name, _ in counters}):
+            lines.append('# TYPE {0} counter'.format(name))
+            lines += ['{0}{1} {2}'.format(name, label(labels), value)
+                      for (key, labels), value in sorted(counters.items()) if key == name]
+        for name, read in sorted(self.gauges.items()):
+            lines.append('# TYPE {0} gauge'.format(name))
+            lines.append('{0} {1}'.format(name, read()))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(tracing=SLOW_LOOKUP is not None)
+
+
+def cache_hit_ratio():
+    hits = METRICS.counters.get(('ordbok_cache_requests_total', (('result', 'hit'),)), 0)
+    misses = METRICS.counters.get(('ordbok_cache_requests_total', (('result', 'miss'),)), 0)
+    return hits / (hits + misses) if hits + misses else 0
+
+
+METRICS.gauge('ordbok_cache_hit_ratio', cache_hit_ratio)
 
 class HttpClient:
+    """
+    Fetches pages over one keep-alive session. Its connection pool holds as
+    many connections per host as there are fetch workers, failed requests
+    are retried with exponential backoff. Given an origin such as
+    http://localhost:5670, requests go there instead of the host in the URL.
+    The session is set up on the first fetch, most lookups hit the cache
+    and never need to import requests.
+    """
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT,
+                 retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, origin=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.origin = urlparse(origin) if origin else None
+        self.session = None
+        self.adapter = None
+        self.lock = Lock()
+
+    def connect(self):
+        with self.lock:
+            if self.session is not None:
+                return self.session
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            session = Session()
+            session.headers.update({
+                'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:59.0) Gecko/20100101 Firefox/59.0',
+                'Accept-Encoding': 'gzip, deflate',
+            })
+            # Without retries an error status comes back as it is, and
+            # raise_for_status reports it, rather than as a RetryError
+            retry = Retry(total=self.retries, backoff_factor=self.backoff,
+                          status_forcelist=[429, 500, 502, 503, 504],
+                          allowed_methods=['GET']) if self.retries else 0
+            self.adapter = HTTPAdapter(pool_maxsize=self.pool_size, max_retries=retry)
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.session = session
+            return session
+
     def get(self, url):
+        return self.fetch(url).content
+
+    def pool_stats(self, url):
+        # Fewer connections than requests means connections were reused
+        host = urlparse(url).hostname
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            if key.key_host == host:
+                pool = pools[key]
+                return 'pool {0}: {1} connections for {2} requests'.format(
+                    host, pool.num_connections, pool.num_requests)
+        return 'no pool for {0}'.format(host)
+
+    def fetch(self, url, etag=None, last_modified=None):
         logging.info('http get "%s"', url)
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:59.0) Gecko/20100101 Firefox/59.0'}
-        result = get(url, headers=headers)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        if self.origin:
+            url = urlunparse(urlparse(url)._replace(scheme=self.origin.scheme,
+                                                    netloc=self.origin.netloc))
+        with METRICS.span('http_fetch', url):
+            result = self.connect().get(url, headers=headers, timeout=self.timeout)
+        METRICS.count('ordbok_http_requests_total', status=result.status_code)
+        METRICS.count('ordbok_http_bytes_total', len(result.content))
+        logging.debug('http %s "%s" in %.0f ms, %s, %s', result.status_code,
+                      url, result.elapsed.total_seconds() * 1000,
+                      result.headers.get('Content-Encoding', 'identity'),
+                      self.pool_stats(url))
+        if result.status_code == 304:
+            return HttpResponse(304, None, etag, last_modified)
         result.raise_for_status()
-        return result.text
+        return HttpResponse(result.status_code, result.text,
+                            result.headers.get('ETag'),
+                            result.headers.get('Last-Modified'))
 
 
-class CachedHttpClient:
-    def __init__(self, client, dirname):
-        self.client = client
+class FileStore:
+    """
+    The original cache layout: one bz2 file per key under a directory. Only
+    the content is stored, the file modification time is the fetch time.
+    """
+    def __init__(self, dirname):
         self.dirname = dirname
 
-    def get(self, url):
-        path = self.get_path(self.get_key(url))
+    def get(self, key):
+        path = self.get_path(key)
         content = slurp(bz2.open, path)
         if content is None:
-            logging.info('cache miss: "%s"', url)
-            content = self.client.get(url)
-            spit(bz2.open, path, content)
-        return content
+            return None
+        return CacheEntry(content, getmtime(path), None, None)
+
+    def put(self, key, entry):
+        path = self.get_path(key)
+        spit(bz2.open, path, entry.content)
+        utime(path, (entry.fetched, entry.fetched))
+
+    def flush(self):
+        pass
+
+    def keys(self):
+        root = self.get_path('')
+        for path, _, filenames in walk(root):
+            for filename in filenames:
+                if not filename.startswith(TEMP_PREFIX):
+                    yield relpath(join(path, filename), root)
 
     def get_path(self, key):
-        return '{0}/{1}/{2}'.format(dirname(__file__), self.dirname, key)
+        return join(dirname(__file__), self.dirname, key)
+
+
+class SqliteStore:
+    """
+    All cache entries in one SQLite file. Writes are buffered and committed
+    together once BATCH_SIZE of them are pending, or by a timer at most
+    FLUSH_INTERVAL seconds after the first of them. Reads see pending writes.
+    """
+    BATCH_SIZE = 64
+    FLUSH_INTERVAL = 5
+    COLUMNS = ['fetched REAL NOT NULL DEFAULT 0', 'etag TEXT',
+               'last_modified TEXT']
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                                '(key TEXT PRIMARY KEY, content TEXT NOT NULL)')
+        existing = [row[1] for row in
+                    self.connection.execute('PRAGMA table_info(cache)')]
+        for column in self.COLUMNS:
+            if column.split()[0] not in existing:
+                self.connection.execute(
+                    'ALTER TABLE cache ADD COLUMN {0}'.format(column))
+        self.connection.commit()
+        self.lock = Lock()
+        self.pending = {}
+        self.timer = None
+        atexit.register(self.flush)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.connection.execute(
+                'SELECT content, fetched, etag, last_modified FROM cache '
+                'WHERE key = ?', (key,)).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def put(self, key, entry):
+        with self.lock:
+            self.pending[key] = entry
+            if len(self.pending) >= self.BATCH_SIZE:
+                self._flush()
+            elif self.timer is None:
+                # Commit a burst of writes even if no more follow
+                self.timer = Timer(self.FLUSH_INTERVAL, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def keys(self):
+        with self.lock:
+            self._flush()
+            rows = self.connection.execute('SELECT key FROM cache').fetchall()
+        return [key for key, in rows]
+
+    def _flush(self):
+        if self.pending:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO cache '
+                '(key, content, fetched, etag, last_modified) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(key,) + tuple(entry) for key, entry in self.pending.items()])
+            self.connection.commit()
+            logging.debug('cache store: committed %d entries', len(self.pending))
+            self.pending = {}
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class LruCache:
+    """
+    Bounded in-memory cache of decoded entries. The bound is the total
+    length of their content, least recently used entries are evicted first.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old.content)
+            self.items[key] = value
+            self.size += len(value.content)
+            while self.size > self.max_size and len(self.items) > 1:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted.content)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'count': len(self.items), 'size': self.size}
+
+    def __repr__(self):
+        return 'LruCache({0})'.format(', '.join(
+            '{0}={1}'.format(k, v) for k, v in self.stats().items()))
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time. Callers that ask for a key while its
+    call is in flight wait for it and share its result or exception.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class CachedHttpClient:
+    """
+    Serves pages from the cache. An entry older than the TTL of its URL is
+    still served right away, and revalidated in the background with a
+    conditional request (stale-while-revalidate). Concurrent misses of the
+    same page share a single request.
+    """
+    def __init__(self, client, store, memory=None, ttls=CACHE_TTLS):
+        self.client = client
+        self.store = store
+        self.memory = memory or LruCache(MEMORY_CACHE_SIZE)
+        self.ttls = ttls
+        self.revalidating = set()
+        self.flight = SingleFlight()
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=REVALIDATE_WORKERS)
+
+    def get(self, url):
+        key = self.get_key(url)
+        with METRICS.span('cache_lookup', url):
+            entry = self.lookup(key)
+        if entry is None:
+            METRICS.count('ordbok_cache_requests_total', result='miss')
+            return self.flight.do(key, lambda: self.fetch_miss(url, key)).content
+        METRICS.count('ordbok_cache_requests_total', result='hit')
+        if time.time() - entry.fetched > self.get_ttl(url):
+            METRICS.count('ordbok_cache_stale_total')
+            self.revalidate(url, key, entry)
+        return entry.content
+
+    def lookup(self, key):
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        return entry
+
+    def fetch_miss(self, url, key):
+        # The previous flight for this key may have finished just before
+        entry = self.lookup(key)
+        if entry is not None:
+            return entry
+        logging.info('cache miss: "%s"', url)
+        return self.fetch(url, key)
+
+    def fetch(self, url, key, entry=None):
+        if entry is None:
+            response = self.client.fetch(url)
+        else:
+            response = self.client.fetch(url, entry.etag, entry.last_modified)
+        if response.status == 304:
+            entry = entry._replace(fetched=time.time())
+        else:
+            entry = CacheEntry(response.content, time.time(),
+                               response.etag, response.last_modified)
+        self.store.put(key, entry)
+        self.memory.put(key, entry)
+        return entry
+
+    def revalidate(self, url, key, entry):
+        with self.lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+        self.executor.submit(self._revalidate, url, key, entry)
+
+    def _revalidate(self, url, key, entry):
+        try:
+            logging.info('cache revalidate: "%s"', url)
+            self.fetch(url, key, entry)
+        except Exception:
+            logging.exception('cache revalidate failed: "%s"', url)
+        finally:
+            with self.lock:
+                self.revalidating.discard(key)
+
+    def get_ttl(self, url):
+        return get_ttl(url, self.ttls)
 
     def get_key(self, url):
         J = lambda x: re.sub(r'\W+', '', x)
@@ -167,15 +724,97 @@ def slurp(do_open, filename):
 
 
 def spit(do_open, filename, content):
+    # Write to a temporary file next to the target and rename it over the
+    # target, so a reader never sees a half-written file
     dir = dirname(filename)
-    if not exists(dir):
-        makedirs(dir)
-    with do_open(filename, 'wb') as file_:
-        file_.write(content.encode())
+    makedirs(dir, exist_ok=True)
+    fd, temp = mkstemp(dir=dir, prefix=TEMP_PREFIX)
+    close(fd)
+    try:
+        with do_open(temp, 'wb') as file_:
+            file_.write(content.encode())
+        replace(temp, filename)
+    except:
+        unlink(temp)
+        raise
+
+
+def get_ttl(url, ttls=CACHE_TTLS):
+    for pattern, ttl in ttls:
+        if pattern.search(url):
+            return ttl
+    return DEFAULT_CACHE_TTL
+
+
+RX_TAG = re.compile(r'<[^>]*>')
+# Part of speech spans read the way BeautifulSoup with lxml reads them: tag
+# and attribute names in any case, values in double, single or no quotes,
+# and the text of any tags inside, e.g. n<sup>1</sup> is "n1". It is assumed
+# that no attribute value contains ">" and that no span is nested in a part,
+# which does not happen in ordbok.cgi pages.
+RX_PART = re.compile(r'<span\b([^>]*\boppsgramordklasse\b[^>]*)>(.*?)</span\s*>',
+                     re.DOTALL | re.IGNORECASE)
+RX_ATTR = re.compile(r'''([^\s"'>/=]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
 
 
 def to_text(html):
-    return BeautifulSoup(html, features='lxml').text
+    # Cheap text of a fragment: drop the tags, decode entities and collapse
+    # whitespace. Good enough to tell inflection tables apart.
+    return ' '.join(unescape(RX_TAG.sub(' ', html)).split())
+
+
+def parse_attrs(text):
+    # The first of repeated attributes counts, like in an HTML parser
+    attrs = {}
+    for m in RX_ATTR.finditer(text):
+        name, *values = m.groups()
+        attrs.setdefault(name.lower(), unescape(next(x for x in values if x is not None)))
+    return attrs
+
+
+def extract_parts(html):
+    """
+    Return (name, onclick) of every part of speech span in an article page.
+    Only those spans are looked at, the page is not parsed as a whole.
+    """
+    parts = []
+    for m in RX_PART.finditer(html):
+        attrs, inner = m.groups()
+        attrs = parse_attrs(attrs)
+        if 'oppsgramordklasse' in attrs.get('class', '').split():
+            parts.append((unescape(RX_TAG.sub('', inner)), attrs.get('onclick', '')))
+    return tuple(parts)
+
+
+class ParseCache:
+    """
+    Parsed parts of the last `max_count` article pages by URL, the key of
+    their cache entries. Only a hash of each page is kept, to tell when its
+    entry was refreshed, so the pages themselves stay within the memory
+    cache bound.
+    """
+    def __init__(self, max_count):
+        self.max_count = max_count
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, url, html, parse):
+        digest = hash(html)
+        with self.lock:
+            item = self.items.get(url)
+            if item is not None and item[0] == digest:
+                self.items.move_to_end(url)
+                return item[1]
+        parts = parse(html)
+        with self.lock:
+            self.items[url] = (digest, parts)
+            self.items.move_to_end(url)
+            while len(self.items) > self.max_count:
+                self.items.popitem(last=False)
+        return parts
+
+
+PARSE_CACHE = ParseCache(PARSE_CACHE_SIZE)
 
 
 def uniq(items, key):
@@ -183,6 +822,129 @@ def uniq(items, key):
     return [x for x in items if not (key(x) in seen or seen.add(key(x)))]
 
 
+class Lexicon:
+    """
+    Words of the suggestion lists seen so far, sorted the Norwegian way with
+    æ, ø and å after z. Once a list shorter than SUGGESTIONS_LIMIT was seen
+    for a prefix, every longer query that starts with it is answered from
+    here without a request, until the list is as old as the cache TTL of
+    suggestions. Then the prefix is asked for again, so new words show up.
+    """
+    ORDER = str.maketrans('æøå', '{|}')
+    # More new words than this are merged with one sort, not inserted one by one
+    INSERT_LIMIT = 32
+    def __init__(self, filename=None, ttl=None):
+        self.filename = filename
+        self.ttl = get_ttl(Suggestions.get_url('')) if ttl is None else ttl
+        self.keys = []
+        self.words = []
+        self.known = set()
+        # Sort key of a complete prefix: when its list was fetched
+        self.complete = {}
+        self.dirty = False
+        self.lock = Lock()
+
+    @staticmethod
+    def load(filename, store=None):
+        # A missing lexicon is built from the suggestion lists in the store
+        lexicon = Lexicon(filename)
+        content = slurp(open, filename)
+        data = None
+        if content is not None:
+            try:
+                data = loads(content)
+            except ValueError as e:
+                logging.warning('lexicon: cannot read %s: %s', filename, e)
+        if data is not None:
+            lexicon.words = data['words']
+            lexicon.keys = [Lexicon.sort_key(x) for x in lexicon.words]
+            lexicon.known = set(lexicon.words)
+            # Complete prefixes used to be a list without times, those are
+            # as good as expired
+            complete = data['complete']
+            lexicon.complete = complete if isinstance(complete, dict) else dict.fromkeys(complete, 0)
+        elif store is not None:
+            lexicon.seed(store)
+        atexit.register(lexicon.save)
+        return lexicon
+
+    @staticmethod
+    def sort_key(word):
+        return word.lower().translate(Lexicon.ORDER)
+
+    def seed(self, store):
+        words = []
+        prefixes = []
+        for key in store.keys():
+            if 'lage_ordliste' not in key:
+                continue
+            entry = store.get(key)
+            m = entry and re.match(r"\{query:'([^']*)'", entry.content)
+            if not m:
+                continue
+            try:
+                items = Suggestions.parse(entry.content)
+            except Exception as e:
+                logging.warning('lexicon: skipping %s: %s', key, e)
+                continue
+            words.extend(items)
+            if m.group(1) and len(items) < SUGGESTIONS_LIMIT:
+                prefixes.append((self.sort_key(m.group(1)), entry.fetched))
+        with self.lock:
+            self._insert(words)
+            for key, fetched in prefixes:
+                self.complete[key] = max(fetched, self.complete.get(key, 0))
+            self.dirty = True
+        logging.info('lexicon: seeded %d words, %d complete prefixes',
+                     len(self.words), len(self.complete))
+
+    def lookup(self, prefix):
+        key = self.sort_key(prefix)
+        fresh = time.time() - self.ttl
+        with self.lock:
+            if not any(self.complete.get(key[:i], 0) >= fresh for i in range(1, len(key) + 1)):
+                return None
+            start = bisect.bisect_left(self.keys, key)
+            end = bisect.bisect_left(self.keys, key + chr(0x10ffff), start)
+            return self.words[start:end]
+
+    def add(self, prefix, words):
+        with self.lock:
+            self._insert(words)
+            if prefix and len(words) < SUGGESTIONS_LIMIT:
+                self.complete[self.sort_key(prefix)] = time.time()
+            self.dirty = True
+
+    def _insert(self, words):
+        new = [x for x in dict.fromkeys(words) if x not in self.known]
+        self.known.update(new)
+        if len(new) <= self.INSERT_LIMIT:
+            for word in new:
+                key = self.sort_key(word)
+                i = bisect.bisect_right(self.keys, key)
+                self.keys.insert(i, key)
+                self.words.insert(i, word)
+            return
+        # Two sorted runs, the sort merges them in linear time
+        pairs = list(zip(self.keys, self.words))
+        pairs += sorted((self.sort_key(x), x) for x in new)
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.words = [word for _, word in pairs]
+
+    def save(self):
+        with self.lock:
+            if not self.dirty or self.filename is None:
+                return
+            content = dumps({'complete': self.complete, 'words': self.words},
+                            ensure_ascii=False)
+            self.dirty = False
+        spit(open, self.filename, content)
+
+    def __repr__(self):
+        return 'Lexicon(words={0}, complete={1})'.format(len(self.words), len(self.complete))
+
+
 class Suggestions:
     # https://ordbok.uib.no/perl/lage_ordliste_liten_nr2000.cgi?spr=bokmaal&query=gam
     #
@@ -191,13 +953,26 @@ class Suggestions:
     # data:["gaman","gamasje","gambe","gambier","gambisk","gambit","gamble","gambler","game","game","gamet","gametofytt","gamla","gamle-","gamleby","gamlefar","gamleheim","gamlehjem","gamlekjжreste","gamlemor","gamlen","gamlestev","gamletid","gamleеr","gamling","gamma","gammaglobulin","gammal","gammaldags","gammaldans","gammaldansk","gammaldansk","gammalengelsk","gammalgresk","gammalkjent","gammalkjжreste","gammalkommunist","gammalmannsaktig","gammalmodig","gammalnorsk","gammalnorsk","gammalost","gammalrosa","gammalstev","gammaltestamentlig","gammaltid","gammalvoren","gammastrеle","gammastrеling","gamme","gammel","gammel jomfru","gammel norsk mil","gammel som alle haugene","gammeldags","gammeldans","gammeldansk","gammeldansk","gammelengelsk","gammelgresk","gammelkjent","gammelkjжreste","gammelkommunist","gammelmannsaktig","gammelmodig","gammelnorsk","gammelnorsk","gammelost","gammelrosa","gammelstev","gammeltestamentlig","gammeltid","gammelvoren","gammen","gamp","gampe"]
     # }
     TOP_COUNT = 5
-    def __init__(self, client, word):
+    def __init__(self, client, word, lexicon=None):
         self.word = word
-        items = loads(self.cleanup(client.get(self.get_url(word)))).get('suggestions', [])
+        items = lexicon.lookup(word) if lexicon else None
+        if items is None:
+            text = client.get(self.get_url(word))
+            with METRICS.span('parse', word):
+                items = self.parse(text)
+            if lexicon:
+                lexicon.add(word, items)
+        else:
+            logging.debug('lexicon: %d suggestions for "%s"', len(items), word)
         self.items = uniq(items, lambda s: s.lower())
         self.top = self.items[:Suggestions.TOP_COUNT]
 
-    def cleanup(self, text):
+    @staticmethod
+    def parse(text):
+        return loads(Suggestions.cleanup(text)).get('suggestions', [])
+
+    @staticmethod
+    def cleanup(text):
         text = '{}'[:1] + '\n' + text[text.index('\n')+1:]
         #a = text.replace("'", '"')
         # :2 because of the syntax parser in neovim plugin, if I leave one
@@ -208,7 +983,8 @@ class Suggestions:
         a = re.sub('^data', '"data"', a, flags=re.MULTILINE)
         return a
 
-    def get_url(self, query):
+    @staticmethod
+    def get_url(query):
         return 'https://ordbok.uib.no/perl/lage_ordliste_liten_nr2000.cgi?spr=bokmaal&query={0}'.format(query)
 
     def __repr__(self):
@@ -224,7 +1000,8 @@ class Inflection:
     def cleanup(self, text):
         return re.sub(r'style="margin:[^"]*"', 'style="margin: 3px;"', text)
 
-    def get_url(self, lid):
+    @staticmethod
+    def get_url(lid):
         return 'https://ordbok.uib.no/perl/bob_hente_paradigme.cgi?lid={0}'.format(lid)
 
     def __repr__(self):
@@ -232,60 +1009,247 @@ class Inflection:
 
 class PartOfSpeech:
     # <span class="oppsgramordklasse" onclick="vise_fullformer(&quot;8225&quot;,'bob')">adj.</span>
-    def __init__(self, client, soup):
-        self.name = soup.text
+    def __init__(self, name, onclick):
+        self.name = name
         self.lid = None
         self.inflection = None
-        m = re.search(r'\d+', soup['onclick'])
+        self.error = None
+        m = re.search(r'\d+', onclick)
         if m:
             self.lid = m.group(0)
-            self.inflection = Inflection(client, self.lid)
 
     def __repr__(self):
         return f'PartOfSpeech(name="{self.name}", lid={self.lid}, inflection={self.inflection})'
 
+class Cancelled(Exception):
+    pass
+
+
+def fetch_inflection(client, lid, cancelled=None):
+    if cancelled is not None and cancelled():
+        raise Cancelled(lid)
+    return Inflection(client, lid)
+
+
 class Article:
     # https://ordbok.uib.no/perl/ordbok.cgi?OPP=bra&ant_bokmaal=5&ant_nynorsk=5&bokmaal=+&ordbok=bokmaal
     # <span class="oppslagsord b" id="22720">gi</span>
     # <span class="oppsgramordklasse" onclick="vise_fullformer(&quot;8225&quot;,'bob')">adj.</span>
-    def __init__(self, client, word):
+    def __init__(self, client, word, executor=None, cancelled=None):
         self.word = word
-        soup = BeautifulSoup(client.get(self.get_url(word)), features='lxml')
-        parts = soup.find_all('span', {"class": "oppsgramordklasse"})
-        parts = [PartOfSpeech(client, x) for x in parts]
-        self.parts = parts
-        self.html = ''.join(uniq([x.inflection.html for x in self.parts], to_text))
-
-    def get_url(self, word: str) -> str:
+        url = self.get_url(word)
+        text = client.get(url)
+        with METRICS.span('parse', word):
+            parts = PARSE_CACHE.get(url, text, extract_parts)
+        self.parts = [PartOfSpeech(name, onclick) for name, onclick in parts]
+        if cancelled is not None and cancelled():
+            raise Cancelled(word)
+        self.fetch_inflections(client, executor or INFLECTION_EXECUTOR, cancelled)
+        self.errors = [x for x in self.parts if x.error is not None]
+        html = uniq([x.inflection.html for x in self.parts if x.inflection], to_text)
+        html += ['<p>Failed to fetch inflection of {0} ({1})</p>'.format(x.name, x.lid)
+                 for x in self.errors]
+        self.html = ''.join(html)
+
+    def fetch_inflections(self, client, executor, cancelled=None):
+        # Fetch all paradigms at once, the parts keep their order and a part
+        # whose paradigm fails keeps the error instead. Once cancelled the
+        # paradigms that have not started yet are skipped.
+        futures = {}
+        for part in self.parts:
+            if part.lid is not None and part.lid not in futures:
+                futures[part.lid] = executor.submit(fetch_inflection, client, part.lid, cancelled)
+        try:
+            for part in self.parts:
+                if part.lid is None:
+                    continue
+                try:
+                    part.inflection = futures[part.lid].result()
+                except Cancelled:
+                    raise
+                except Exception as e:
+                    logging.warning('inflection %s of "%s" failed: %s', part.lid, self.word, e)
+                    part.error = e
+        except Cancelled:
+            for future in futures.values():
+                future.cancel()
+            raise
+
+    @staticmethod
+    def get_url(word: str) -> str:
         return 'https://ordbok.uib.no/perl/ordbok.cgi?OPP={0}&ant_bokmaal=5&ant_nynorsk=5&bokmaal=+&ordbok=bokmaal'.format(word)
 
     def __repr__(self):
         return f'Article(word={self.word}, parts={self.parts})'
 
 
+# Inflection requests of the articles shown in the window. The articles
+# themselves run on AsyncFetch threads, so waiting on this pool cannot
+# deadlock. The GoldenDict proxy has a pool of its own, so that a large batch
+# does not queue ahead of the window.
+INFLECTION_EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+# Prefetched articles get their own so they never delay interactive ones
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+
 class AsyncFetch(QObject):
+    """
+    Runs fetch tasks on a pool of threads, lower priority first.
+
+    Tasks are added under a kind and adding a task supersedes the older
+    tasks of that kind: queued ones are dropped and running ones see their
+    cancelled() turn true, so they can stop before further requests and
+    their results are never emitted. The threads start with the first task.
+
+    """
     ready = pyqtSignal(object)
     def __init__(self, client):
         super(AsyncFetch, self).__init__()
         self.client = client
-        self.queue = Queue()
-        for _ in range(10):
-            Thread(target=self._serve, daemon=True).start()
-    def add(self, task):
-        self.queue.put(task)
+        self.queue = PriorityQueue()
+        self.order = count()
+        self.lock = Lock()
+        self.generations = {}
+        self.started = False
+        METRICS.gauge('ordbok_fetch_queue_depth', self.queue.qsize)
+    def add(self, task, kind=None, priority=INTERACTIVE, supersede=True):
+        with self.lock:
+            if not self.started:
+                for _ in range(FETCH_WORKERS):
+                    Thread(target=self._serve, daemon=True).start()
+                self.started = True
+            if supersede:
+                self.generations[kind] = self.generations.get(kind, 0) + 1
+            generation = self.generations.setdefault(kind, 0)
+        self.queue.put((priority, next(self.order), kind, generation, task, time.perf_counter()))
+    def cancel(self, kind):
+        with self.lock:
+            self.generations[kind] = self.generations.get(kind, 0) + 1
+    def is_current(self, kind, generation):
+        return self.generations[kind] == generation
     def _serve(self):
         while True:
-            task = self.queue.get()
-            result = task(self.client)
-            self.ready.emit(result)
+            _, _, kind, generation, task, queued = self.queue.get()
+            METRICS.observe('queue_wait', time.perf_counter() - queued, kind, queued)
+            cancelled = lambda kind=kind, generation=generation: not self.is_current(kind, generation)
+            if cancelled():
+                logging.debug('dropped superseded %s task', kind)
+                continue
+            try:
+                with METRICS.span(kind or 'task'):
+                    result = task(self.client, cancelled)
+            except Cancelled as e:
+                logging.debug('cancelled %s task: %s', kind, e)
+                continue
+            except Exception:
+                logging.exception('%s task failed', kind)
+                continue
+            if result is not None and not cancelled():
+                self.ready.emit(result)
+
+
+class Prefetcher(QObject):
+    """
+    Warms the cache with the articles of suggested words.
+
+    Articles are fetched as BACKGROUND tasks of AsyncFetch, throttled by
+    the PREFETCH_* limits. Their results are not emitted, choosing one of
+    the words later finds everything in the cache. cancel() drops the
+    words that have not finished yet.
+
+    """
+    KIND = 'prefetch'
+    def __init__(self, async_fetch, workers=PREFETCH_WORKERS,
+                 interval=PREFETCH_INTERVAL, budget=PREFETCH_BUDGET):
+        super(Prefetcher, self).__init__()
+        self.async_fetch = async_fetch
+        self.workers = workers
+        self.budget = budget
+        self.pending = []
+        self.done = set()
+        self.lock = Lock()
+        self.generation = 0
+        self.running = 0
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.start_next)
+
+    def prefetch(self, words):
+        self.cancel()
+        self.pending = [x for x in words if x not in self.done]
+        if self.pending and self.budget > 0:
+            self.timer.start()
+
+    def cancel(self):
+        self.pending = []
+        self.timer.stop()
+        with self.lock:
+            self.generation += 1
+            self.running = 0
+        self.async_fetch.cancel(Prefetcher.KIND)
+
+    def start_next(self):
+        if not self.pending or self.budget <= 0:
+            self.timer.stop()
+            return
+        with self.lock:
+            if self.running >= self.workers:
+                return
+            self.running += 1
+            generation = self.generation
+        word = self.pending.pop(0)
+        self.budget -= 1
+        self.async_fetch.add(lambda client, cancelled: self.fetch(client, word, generation, cancelled),
+                             Prefetcher.KIND, BACKGROUND, supersede=False)
+
+    def fetch(self, client, word, generation, cancelled):
+        try:
+            Article(client, word, PREFETCH_EXECUTOR, cancelled)
+            self.done.add(word)
+            logging.debug('prefetched "%s"', word)
+        finally:
+            with self.lock:
+                if generation == self.generation:
+                    self.running -= 1
+
+
+class Activation(QObject):
+    """
+    Carries WatchDog commands from its socket threads to the GUI thread.
+    """
+    shown = pyqtSignal()
+    lookup = pyqtSignal(str)
+    quit = pyqtSignal()
+    def on_command(self, command, argument):
+        if command == 'show':
+            self.shown.emit()
+        elif command == 'lookup':
+            self.lookup.emit(argument)
+        elif command == 'quit':
+            self.quit.emit()
+
+
+class RenderedArticle(namedtuple('RenderedArticle', 'content document')):
+    """
+    An article's HTML and its laid out QTextDocument, an LruCache entry.
+    """
 
 
 class MainWindow(QWidget):
-    def __init__(self, app):
+    interactive = pyqtSignal()
+    def __init__(self, app, client, lexicon=None):
         super().__init__()
         self.app = app
-        self.async_fetch = AsyncFetch(CachedHttpClient(HttpClient(), 'cache'))
+        self.lexicon = lexicon
+        self.painted = False
+        self.async_fetch = AsyncFetch(client)
         self.async_fetch.ready.connect(self.on_fetch_ready)
+        self.prefetcher = Prefetcher(self.async_fetch) if PREFETCH_COUNT else None
+        self.changed = time.perf_counter()
+        self.documents = LruCache(DOCUMENT_CACHE_SIZE)
+        self.document = None
+        self.history = []
+        self.position = -1
 
         self.comboxBox = QComboBox(self)
         self.comboxBox.setEditable(True)
@@ -297,7 +1261,7 @@ class MainWindow(QWidget):
         self.comboxBox.setFont(font)
 
         self.browser = QTextBrowser(self)
-        self.browser.setText(STYLE + HTML)
+        self.browser.setText(STYLE)
         self.browser.show()
 
         mainLayout = QVBoxLayout(self)
@@ -316,6 +1280,15 @@ class MainWindow(QWidget):
         self.center()
         self.show()
 
+    def paintEvent(self, e):
+        super().paintEvent(e)
+        if not self.painted:
+            self.painted = True
+            seconds = perf_counter() - STARTED
+            METRICS.observe('startup', seconds)
+            logging.info('time to interactive: %.0f ms', seconds * 1000)
+            QTimer.singleShot(0, self.interactive.emit)
+
     def activate(self):
         self.center()
         self.show()
@@ -324,6 +1297,17 @@ class MainWindow(QWidget):
         self.comboxBox.lineEdit().selectAll()
         self.comboxBox.setFocus()
 
+    def lookup(self, word):
+        # Fetch right away, the word was not typed and needs no debounce
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.comboxBox.blockSignals(True)
+        self.comboxBox.setCurrentText(word)
+        self.comboxBox.blockSignals(False)
+        self.changed = time.perf_counter()
+        self.fetch(word)
+        self.activate()
+
     def center(self):
         qr = self.frameGeometry()
         desktop = QApplication.desktop()
@@ -338,34 +1322,91 @@ class MainWindow(QWidget):
         self.comboxBox.setCompleter(completer)
         completer.complete()
 
-    def set_text(self, text):
-        self.browser.setText(STYLE + text)
+    def show_article(self, word, html):
+        # An article shown before is swapped in without parsing its HTML again
+        rendered = self.documents.get(word)
+        if rendered is None or rendered.content != html:
+            with METRICS.span('render'):
+                document = QTextDocument()
+                document.setDefaultFont(self.browser.font())
+                document.setHtml(STYLE + html)
+            rendered = RenderedArticle(html, document)
+            self.documents.put(word, rendered)
+        if rendered.document is not self.document:
+            with METRICS.span('swap'):
+                self.browser.setDocument(rendered.document)
+            # The browser does not own its document, keep it alive even when
+            # it is evicted from the cache
+            self.document = rendered.document
+
+    def remember(self, word):
+        if self.position >= 0 and self.history[self.position] == word:
+            return
+        del self.history[self.position + 1:]
+        self.history.append(word)
+        del self.history[:-HISTORY_SIZE]
+        self.position = len(self.history) - 1
+
+    def go(self, step):
+        # Back and forward through the words shown, fetching only those whose
+        # documents were evicted
+        position = self.position + step
+        if not 0 <= position < len(self.history):
+            return
+        self.position = position
+        word = self.history[position]
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.comboxBox.blockSignals(True)
+        self.comboxBox.setCurrentText(word)
+        self.comboxBox.blockSignals(False)
+        rendered = self.documents.get(word)
+        if rendered is not None:
+            self.show_article(word, rendered.content)
+        else:
+            self.changed = time.perf_counter()
+            self.fetch(word)
 
     def on_text_changed(self, text):
+        if self.prefetcher:
+            self.prefetcher.cancel()
         if text == '':
             return
 
+        self.changed = time.perf_counter()
         QTimer.singleShot(UPDATE_DELAY, lambda: self.update(text))
 
     def update(self, old_text):
         if self.same_text(old_text):
+            METRICS.observe('debounce', time.perf_counter() - self.changed, old_text, self.changed)
             self.fetch(old_text)
 
+    def lookup_done(self, word):
+        # From the last edit of the query until its article is shown
+        seconds = time.perf_counter() - self.changed
+        METRICS.observe('lookup', seconds, word, self.changed)
+        if SLOW_LOOKUP is not None and seconds > SLOW_LOOKUP:
+            METRICS.dump('slow lookup of "{0}" in {1:.0f} ms'.format(word, seconds * 1000), self.changed)
+
     @pyqtSlot(object)
     def on_fetch_ready(self, result: object):
         if isinstance(result, Article):
             if self.same_text(result.word) and result.parts:
-                self.set_text(result.html)
+                self.show_article(result.word, result.html)
+                self.remember(result.word)
+                self.lookup_done(result.word)
         elif isinstance(result, Suggestions):
             if self.same_text(result.word) and result.top:
                 print(result)
                 self.suggest(result.top)
+                if self.prefetcher:
+                    self.prefetcher.prefetch([x for x in result.top[:PREFETCH_COUNT] if x != result.word])
         else:
             logging.warn('unknown fetch result: %s', result)
 
     def fetch(self, word):
-        self.async_fetch.add(lambda client: Article(client, word))
-        self.async_fetch.add(lambda client: Suggestions(client, word))
+        self.async_fetch.add(lambda client, cancelled: Article(client, word, cancelled=cancelled), 'article')
+        self.async_fetch.add(lambda client, cancelled: Suggestions(client, word, self.lexicon), 'suggestions')
 
     def onTrayActivated(self, reason):
         if reason == QSystemTrayIcon.Trigger:
@@ -385,10 +1426,23 @@ class MainWindow(QWidget):
         elif (e.key() == Qt.Key_L) and (e.modifiers() == Qt.ControlModifier):
             self.comboxBox.lineEdit().selectAll()
             self.comboxBox.setFocus()
+        elif e.matches(QKeySequence.Back):
+            self.go(-1)
+        elif e.matches(QKeySequence.Forward):
+            self.go(1)
         elif e.key() == Qt.Key_Return:
+            self.changed = time.perf_counter()
             self.fetch(self.text())
 
 
+class RenderedPage(namedtuple('RenderedPage', 'content gzipped etag created html')):
+    @staticmethod
+    def make(content, html=None):
+        # Weak, because the gzipped body is the same page in other bytes
+        return RenderedPage(content, gzip.compress(content),
+                            'W/"{0}"'.format(md5(content).hexdigest()), time.time(), html)
+
+
 PRELUDE = '''
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
 <html xmlns="http://www.w3.org/1999/xhtml">
@@ -418,78 +1472,183 @@ PRELUDE = '''
 </html>
 '''
 
-from flask import Flask, Response
 class GoldenDictProxy:
-    def __init__(self, client, host, port):
+    """
+    Serves articles as full pages to GoldenDict. Blocking fetches run on a
+    bounded pool, concurrent requests for a page share one render, and
+    rendered pages are kept in memory together with their gzipped body.
+    Clients revalidate them with If-None-Match. Many words can be looked up
+    at once with a POST to /ordbok/batch, one word per line or a JSON list,
+    results are streamed as NDJSON in the order they complete.
+
+    FastAPI and uvicorn are imported by serve(), on the thread of the proxy.
+    """
+    def __init__(self, client, host, port, workers=PROXY_WORKERS,
+                 max_age=PROXY_MAX_AGE):
         self.client = client
         self.host = host
         self.port = port
-        self.app = Flask(__name__)
+        self.max_age = max_age
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.inflections = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+        self.pages = LruCache(PROXY_CACHE_SIZE)
+        self.rendering = {}
+        self.css = None
+        METRICS.gauge('ordbok_proxy_renders_in_flight', lambda: len(self.rendering))
     def serve_background(self):
         Thread(target=self.serve, daemon=True).start()
     def serve(self):
+        from fastapi import FastAPI
+        from uvicorn import Config, Server
+        app = FastAPI()
+        app.add_route('/ordbok/inflect/{word}', self.route_ordbok_inflect, ['GET'])
+        app.add_route('/ordbok/batch', self.route_ordbok_batch, ['POST'])
+        app.add_route('/metrics', self.route_metrics, ['GET'])
+        app.add_route('/glosbe/noru/{word}', self.route_glosbe_noru, ['GET'])
+        app.add_route('/static/css/ord-concatenated.css', self.route_css, ['GET'])
         logging.info('Starting GoldenDictProxy on %s:%s', self.host, self.port)
-        self.app.route('/ordbok/inflect/<word>', methods=['GET'])(self.route_ordbok_inflect)
-        self.app.route('/glosbe/noru/<word>', methods=['GET'])(self.route_glosbe_noru)
-        self.app.route('/static/css/ord-concatenated.css', methods=['GET'])(self.route_css)
-        self.app.run(host=self.host, port=self.port, debug=True, use_reloader=False)
-    def route_glosbe_noru(self, word):
-        url = 'https://nb.glosbe.com/nb/ru/{0}'.format(word)
-        result = self.client.get(url)
+        Server(Config(app, host=self.host, port=self.port, log_level='info')).run()
+    def response(self, *args, **kwargs):
+        from fastapi.responses import Response
+        return Response(*args, **kwargs)
+    async def route_glosbe_noru(self, request):
+        import asyncio
         #https://nb.glosbe.com/nb/ru/gift
-        return result
-    def route_ordbok_inflect(self, word):
+        url = 'https://nb.glosbe.com/nb/ru/{0}'.format(request.path_params['word'])
+        result = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.client.get, url)
+        return self.response(result, media_type='text/html; charset=utf-8')
+    async def route_metrics(self, request):
+        return self.response(METRICS.render(), media_type='text/plain; version=0.0.4')
+    async def route_ordbok_inflect(self, request):
+        word = request.path_params['word']
         logging.info('Inflect: %s', word)
-        r = Response(open('barn.html').read())
-        r.headers['age'] = '0'
-        r.headers['cache-control'] = 'public,must-revalidate,max-age=600,s-maxage=0'
-        r.headers['content-type'] = 'text/html; charset=utf-8'
-        r.headers['server'] = 'nginx'
-        r.headers['via'] = '1.1 varnish-v4'
-        r.headers['x-cache'] = 'MISS'
-        r.headers['x-cache-hits'] = '0'
-        r.headers['x-debug-max-age-sec'] = '43200'
-        r.headers['x-debugdb'] = 'ok'
-        r.headers['x-varnish'] = '28182065'
-        #date: Sun, 03 Oct 2021 14:24:58 GMT
-        #last-modified: Sun, 03 Oct 2021 14:24:58 GMT
-        from datetime import datetime, timezone
-        r.headers['last-modified'] = datetime.now(timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT') #r.headers['date']
-        return r
-        #return self.format(Article(self.client, word).html)
-        #return 'word: {0}'.format(word)
+        started = time.perf_counter()
+        try:
+            page = await self.render(word)
+            seconds = time.perf_counter() - started
+            METRICS.observe('proxy_lookup', seconds, word, started)
+            if SLOW_LOOKUP is not None and seconds > SLOW_LOOKUP:
+                METRICS.dump('slow proxy lookup of "{0}" in {1:.0f} ms'.format(word, seconds * 1000), started)
+        except Exception as e:
+            logging.exception('Inflect: %s failed', word)
+            return self.response('Failed to fetch {0}: {1}'.format(word, e), status_code=502)
+        if page is None:
+            return self.response('No article for {0}'.format(word), status_code=404)
+        return self.respond(request, page, 'text/html; charset=utf-8')
+    async def route_ordbok_batch(self, request):
+        from fastapi.responses import StreamingResponse
+        try:
+            body = (await request.body()).decode()
+        except UnicodeDecodeError:
+            return self.response('Expected UTF-8 text', status_code=400)
+        if request.headers.get('content-type', '').startswith('application/json'):
+            try:
+                words = loads(body)
+            except ValueError:
+                words = None
+            if not isinstance(words, list) or not all(isinstance(x, str) for x in words):
+                return self.response('Expected a JSON list of words', status_code=400)
+        else:
+            words = body.splitlines()
+        words = uniq([x.strip() for x in words if x.strip()], lambda x: x)
+        if len(words) > BATCH_MAX_WORDS:
+            return self.response('At most {0} words per batch'.format(BATCH_MAX_WORDS), status_code=413)
+        logging.info('Batch: %d words', len(words))
+        return StreamingResponse(self.lookup_batch(words), media_type='application/x-ndjson')
+    async def lookup_batch(self, words):
+        import asyncio
+        # A batch keeps at most as many renders queued as there are workers,
+        # so single lookups from GoldenDict do not wait behind all of it
+        slots = asyncio.Semaphore(PROXY_WORKERS)
+        async def lookup(word):
+            async with slots:
+                started = time.monotonic()
+                result = {'word': word}
+                try:
+                    page = await self.render(word)
+                    if page is None:
+                        result['status'] = 404
+                    else:
+                        result.update(status=200, html=page.html)
+                except Exception as e:
+                    result.update(status=502, error=str(e))
+                result['ms'] = round((time.monotonic() - started) * 1000, 1)
+                return result
+        tasks = [asyncio.ensure_future(lookup(x)) for x in words]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield dumps(await task, ensure_ascii=False) + '\n'
+        finally:
+            for task in tasks:
+                task.cancel()
+    async def route_css(self, request):
+        if self.css is None:
+            with open(dirname(__file__) + '/ord-concatenated.css', 'rb') as f:
+                self.css = RenderedPage.make(f.read())
+        return self.respond(request, self.css, 'text/css')
+    def respond(self, request, page, media_type):
+        headers = {'ETag': page.etag, 'Vary': 'Accept-Encoding',
+                   'Cache-Control': 'public, max-age={0}'.format(self.max_age)}
+        etags = [x.strip() for x in request.headers.get('if-none-match', '').split(',')]
+        if page.etag in etags or '*' in etags:
+            return self.response(status_code=304, headers=headers)
+        body = page.content
+        if 'gzip' in request.headers.get('accept-encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            body = page.gzipped
+        return self.response(body, media_type=media_type, headers=headers)
+    async def render(self, word):
+        import asyncio
+        # Pages are rendered again once clients would revalidate them,
+        # the client below has its own cache of the fetched pages
+        page = self.pages.get(word)
+        if page is not None and time.time() - page.created <= self.max_age:
+            return page
+        future = self.rendering.get(word)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, self.render_page, word)
+            self.rendering[word] = future
+            future.add_done_callback(lambda _: self.rendering.pop(word, None))
+        return await asyncio.shield(future)
+    def render_page(self, word):
+        with METRICS.span('proxy_render', word):
+            article = Article(self.client, word, self.inflections)
+        if not article.parts:
+            return None
+        page = RenderedPage.make(self.format(article.html).encode(), article.html)
+        if not article.errors:
+            self.pages.put(word, page)
+        return page
     def format(self, html):
         return PRELUDE.format(html)
-    def route_css(self):
-        body = open('./ord-concatenated.css').read()
-        return Response(body, mimetype='text/css')
 
-        # result = '<html><head>{0}</head><body>{1}</body></html>'.format(PROXY_STYLE, html)
-        # return pretty(result)
-
-        #return '<html><head>{0}</head><body>{1}</body></html>'.format(STYLE, html)
-        #return '{0}{1}'.format(STYLE, html)
-        #return '{0}'.format(html)
-
-        # x = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">'
-        # x += '<html xmlns="http://www.w3.org/1999/xhtml">'
-        # x += '<body>'
-        # x += html
-        # x += '</body>'
-        # x += '</html>'
-        # return x
 
 def pretty(html):
+    from bs4 import BeautifulSoup
     return BeautifulSoup(html, features='lxml').prettify()
 
 
 if __name__ == '__main__':
-    client = CachedHttpClient(HttpClient(), 'cache')
-    golden_dict_proxy = GoldenDictProxy(client, 'localhost', 5660)
-    golden_dict_proxy.serve_background()
+    store = SqliteStore(CACHE_FILENAME)
+    client = CachedHttpClient(HttpClient(), store)
 
     app = QApplication(sys.argv)
-    window = MainWindow(app)
+    window = MainWindow(app, client)
+
+    def load_lexicon():
+        # Suggestions come from the network until the lexicon is ready
+        window.lexicon = Lexicon.load(LEXICON_FILENAME, store)
+
+    def on_interactive():
+        # What the search box can do without until it is on screen, the
+        # lexicon is loaded off the GUI thread not to freeze it
+        Thread(target=load_lexicon, daemon=True).start()
+        if PROXY_PORT:
+            golden_dict_proxy = GoldenDictProxy(client, 'localhost', PROXY_PORT)
+            golden_dict_proxy.serve_background()
+    window.interactive.connect(on_interactive)
 
     tray = QSystemTrayIcon(QIcon(dirname(__file__)+'/ordbok_uib_no.png'), app)
     menu = QMenu()
@@ -506,7 +1665,14 @@ if __name__ == '__main__':
     tray.activated.connect(window.onTrayActivated)
     tray.show()
 
-    dog.observe(window.activate)
+    activation = Activation()
+    activation.shown.connect(window.activate)
+    activation.lookup.connect(window.lookup)
+    activation.quit.connect(app.quit)
+    dog.observe(activation.on_command)
+    if args.lookup:
+        window.lookup(args.lookup)
 
     result = app.exec()
+    dog.stop()
 
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import exists
+from threading import BoundedSemaphore, Lock
+
+from ordbok_uib_no import (Article, CachedHttpClient, HttpClient, SqliteStore,
+                           Suggestions, CACHE_FILENAME)
+
+REPORT_EVERY = 100
+
+
+class Throttle:
+    """
+    Wraps an HttpClient: at most `concurrency` requests are in flight and
+    they start no more often than `rate` per second.
+    """
+    def __init__(self, client, concurrency, rate):
+        self.client = client
+        self.slots = BoundedSemaphore(concurrency)
+        self.interval = 1 / rate if rate else 0
+        self.lock = Lock()
+        self.next_start = time.monotonic()
+        self.requests = 0
+        self.bytes = 0
+
+    def fetch(self, url, etag=None, last_modified=None):
+        with self.slots:
+            self.wait()
+            response = self.client.fetch(url, etag, last_modified)
+        with self.lock:
+            self.bytes += len(response.content or '')
+        return response
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+            self.requests += 1
+        if start > now:
+            time.sleep(start - now)
+
+
+class Checkpoint:
+    """
+    Jobs that are done, one "kind<Tab>text" per line. The file is appended
+    to as jobs finish, so an interrupted run resumes where it stopped.
+    """
+    def __init__(self, filename):
+        self.done = set()
+        if exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                self.done = {tuple(line.rstrip('\n').split('\t', 1)) for line in f}
+        self.file = open(filename, 'a', encoding='utf-8')
+        self.lock = Lock()
+
+    def add(self, job):
+        with self.lock:
+            self.file.write('\t'.join(job) + '\n')
+            self.file.flush()
+
+
+class Report:
+    def __init__(self, throttle, total, skipped):
+        self.throttle = throttle
+        self.total = total
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.started
+        rate = lambda x: x / elapsed if elapsed else 0
+        return ('{0}/{1} jobs done, {2} failed, {3} skipped in {4:.1f} s: '
+                '{5:.1f} jobs/s, {6} requests ({7:.1f}/s), {8:.0f} KB ({9:.1f} KB/s)').format(
+            self.done, self.total, self.failed, self.skipped, elapsed,
+            rate(self.done), self.throttle.requests, rate(self.throttle.requests),
+            self.throttle.bytes / 1024, rate(self.throttle.bytes / 1024))
+
+
+def read_words(filename):
+    # One word per line, or a frequency list with the count before or after
+    # the word, separated by whitespace
+    words = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                words.append(re.sub(r'^\d+\s+|\s+\d+$', '', line))
+    return words
+
+
+def make_jobs(words, prefix_length):
+    # The suggestion prefixes a user types on the way to each word, then
+    # the article of the word itself
+    jobs = []
+    seen = set()
+    for word in words:
+        for size in range(1, min(prefix_length, len(word)) + 1):
+            jobs.append(('suggestions', word[:size]))
+        jobs.append(('article', word))
+    return [x for x in jobs if not (x in seen or seen.add(x))]
+
+
+def warm(client, job, inflections):
+    kind, text = job
+    if kind == 'article':
+        article = Article(client, text, inflections)
+        if article.errors:
+            raise article.errors[0].error
+    else:
+        Suggestions(client, text)
+
+
+def is_retryable(e):
+    # Network and server errors pass, a missing or malformed page does not
+    response = getattr(e, 'response', None)
+    return isinstance(e, OSError) and (
+        response is None or response.status_code == 429 or response.status_code >= 500)
+
+
+def with_retries(fn, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = backoff * 2 ** attempt
+            logging.warning('%s, retrying in %.1f s', e, delay)
+            time.sleep(delay)
+
+
+def run(args):
+    # Requests are retried here rather than in the client, so that every
+    # attempt waits for the throttle
+    throttle = Throttle(HttpClient(pool_size=args.workers, retries=0, origin=args.origin),
+                        args.workers, args.rate)
+    client = CachedHttpClient(throttle, SqliteStore(args.store))
+    checkpoint = Checkpoint(args.checkpoint or args.words + '.progress')
+    jobs = make_jobs(read_words(args.words), args.prefix_length)
+    pending = [x for x in jobs if x not in checkpoint.done][:args.limit]
+    report = Report(throttle, len(pending), len(jobs) - len(pending))
+    logging.info('warming %d jobs, %d already done', len(pending), report.skipped)
+
+    inflections = ThreadPoolExecutor(max_workers=args.workers)
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    futures = {executor.submit(with_retries, lambda job=job: warm(client, job, inflections),
+                               args.retries, args.backoff): job for job in pending}
+    try:
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                future.result()
+                checkpoint.add(job)
+                report.done += 1
+            except Exception as e:
+                logging.error('%s "%s" failed: %s', job[0], job[1], e)
+                report.failed += 1
+            if (report.done + report.failed) % REPORT_EVERY == 0:
+                logging.info('%s', report)
+    except KeyboardInterrupt:
+        logging.info('interrupted, the next run resumes from %s', checkpoint.file.name)
+        executor.shutdown(wait=False, cancel_futures=True)
+    client.store.flush()
+    print(report)
+    return report.failed == 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='fill the ordbok_uib_no cache from a word list')
+    parser.add_argument('words', help='word list, or frequency list of "count word" lines')
+    parser.add_argument('--store', default=CACHE_FILENAME, help='SQLite cache file')
+    parser.add_argument('--checkpoint', help='progress file, WORDS.progress by default')
+    parser.add_argument('--workers', type=int, default=4, help='requests in flight')
+    parser.add_argument('--rate', type=float, default=5, help='requests per second, 0 for no limit')
+    parser.add_argument('--retries', type=int, default=3, help='retries of a job on network errors')
+    parser.add_argument('--backoff', type=float, default=1, help='seconds before the first retry, doubled every time')
+    parser.add_argument('--prefix-length', type=int, default=3,
+                        help='fetch suggestions for word prefixes up to this length, 0 for none')
+    parser.add_argument('--limit', type=int, help='stop after this many jobs')
+    parser.add_argument('--origin', help='fetch from another server, e.g. http://localhost:5670 of ordbok_stub.py')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run(parse_args()) else 1)